@@ -265,20 +265,32 @@ class Answerfile:
             if rtype == 'local':
                 address = "Install disc"
             elif rtype in ['url', 'nfs']:
-                address = getText(i)
+                rtype, address = self._parseRemoteSource(rtype, getText(i))
+            elif rtype == 'mirrors':
+                # equivalent copies of one repository, read concurrently
+                address = []
+                for mirror in getElementsByTagName(i, ['mirror'], mandatory=True):
+                    mtype = getStrAttribute(mirror, ['type'], mandatory=True)
+                    if mtype not in ['url', 'nfs']:
+                        raise AnswerfileException("Invalid type for <mirror> media specified.")
+                    address.append(self._parseRemoteSource(mtype, getText(mirror)))
             else:
                 raise AnswerfileException("Invalid type for <source> media specified.")
-            if rtype == 'url' and address.startswith('nfs://'):
-                rtype = 'nfs'
-                address = address[6:]
-
-            if rtype == 'url':
-                address = util.URL(address)
 
             results['sources'].append({'media': rtype, 'address': address})
 
         return results
 
+    @staticmethod
+    def _parseRemoteSource(rtype, address):
+        if rtype == 'url' and address.startswith('nfs://'):
+            rtype = 'nfs'
+            address = address[6:]
+
+        if rtype == 'url':
+            address = util.URL(address)
+        return (rtype, address)
+
     def parseDriverSource(self):
         results = {}
         for source in getElementsByTagName(self.top_node, ['driver-source']):
@@ -12,13 +12,20 @@
 
 import os
 import os.path
+import sys
 import subprocess
 import datetime
+import time
 import re
 import tempfile
+import threading
+import hashlib
+import Queue
+import simplejson as json
 
 import repository
 import generalui
+import progressbus
 import xelogging
 import util
 import diskutil
@@ -59,11 +66,16 @@ class Task:
     'returns' is a list of the labels of the return values, or a function
            that, when given the 'args' labels list, returns the list of the
            labels of the return values.
+    'resources' is a list of tags naming shared state the function touches
+           beyond its labels (e.g. bind mounts in the target root); tasks
+           sharing a tag are never run concurrently.
+    'exclusive' forces the task to run on its own, after every task before
+           it and before every task after it.
     """
 
     def __init__(self, fn, args, returns, args_sensitive=False,
                  progress_scale=1, pass_progress_callback=False,
-                 progress_text=None):
+                 progress_text=None, resources=None, exclusive=False):
         self.fn = fn
         self.args = args
         self.returns = returns
@@ -71,8 +83,43 @@ class Task:
         self.progress_scale = progress_scale
         self.pass_progress_callback = pass_progress_callback
         self.progress_text = progress_text
-
-    def execute(self, answers, progress_callback=lambda x: ()):
+        self.resources = set(resources or [])
+
+        # Tasks whose inputs or outputs cannot be determined up front, or
+        # which drive the UI themselves, cannot be overlapped safely.
+        self.exclusive = (exclusive or pass_progress_callback or
+                          self.inputs() is None or self.outputs() is None)
+
+    def inputs(self):
+        """ Return the set of labels read by this task, or None if unknown. """
+        labels = getattr(self.args, 'labels', None)
+        if labels is None:
+            return None
+        return set(labels)
+
+    def outputs(self):
+        """ Return the set of labels written by this task, or None if unknown. """
+        if callable(self.returns):
+            return None
+        return set(self.returns)
+
+    def conflicts(self, other):
+        """ Return whether this task and 'other' must keep their relative
+        order in a sequence. """
+        if self.exclusive or other.exclusive:
+            return True
+        if self.resources & other.resources:
+            return True
+        return bool(self.outputs() & (other.inputs() | other.outputs()) or
+                    self.inputs() & other.outputs())
+
+    def name(self):
+        name = getattr(self.fn, '__name__', str(self.fn))
+        if getattr(self.fn, 'im_self', None) is not None:
+            name = "%s.%s" % (self.fn.im_self, name)
+        return name
+
+    def execute(self, answers, progress_callback=lambda x: (), phase=None):
         args = self.args(answers)
         assert type(args) == list
 
@@ -84,7 +131,19 @@ class Task:
         if self.pass_progress_callback:
             args.insert(0, progress_callback)
 
-        rv = apply(self.fn, args)
+        start = time.time()
+        status = 'failed'
+        try:
+            rv = apply(self.fn, args)
+            status = 'completed'
+        finally:
+            end = time.time()
+            logger.log("TASK: %s %s in %.3fs" % (self.name(), status, end - start))
+            xelogging.recordTask({'task': self.name(), 'phase': phase,
+                                  'start': start, 'end': end,
+                                  'duration': end - start,
+                                  'progress_scale': self.progress_scale,
+                                  'status': status})
         if type(rv) is not tuple:
             rv = (rv,)
         myrv = {}
@@ -105,30 +164,119 @@ class Task:
 #    the labels when the function is called (late-binding)
 # As: As above but evaluated immediately (early-binding)
 # Use A when you require state values as well as the initial input values
-A = lambda ans, *params: ( lambda a: [a.get(param) for param in params] )
-As = lambda ans, *params: ( lambda _: [ans.get(param) for param in params] )
+# The returned functions carry the labels they read from the state, which is
+# how the scheduler works out what each task depends on.
+def A(ans, *params):
+    fn = lambda a: [a.get(param) for param in params]
+    fn.labels = params
+    return fn
+
+def As(ans, *params):
+    fn = lambda _: [ans.get(param) for param in params]
+    fn.labels = ()
+    return fn
+
+class TaskScheduler:
+    """
+    Runs a sequence of Tasks, overlapping those that do not conflict (see
+    Task.conflicts) on up to 'max_workers' threads.  Task n is only started
+    once every earlier task it conflicts with has completed, so the outcome
+    is the same as running the sequence in order.
+    """
+
+    def __init__(self, sequence, max_workers, phase=None):
+        self.sequence = sequence
+        self.max_workers = max_workers
+        self.phase = phase
+        self.deps = [set(i for i in range(n) if sequence[i].conflicts(sequence[n]))
+                     for n in range(len(sequence))]
+
+    def run(self, answers, progress_callback):
+        """ Generator yielding ('start', task) when a task is started and
+        ('done', task, updated_state) when it has completed.  The caller must
+        apply updated_state to answers before resuming the generator.
+        Exclusive tasks are run in the calling thread. """
+        results = Queue.Queue()
+        pending = range(len(self.sequence))
+        running = set()
+        done = set()
+        failure = None
+
+        def worker(n):
+            try:
+                results.put((n, self.sequence[n].execute(answers, phase=self.phase), None))
+            except:
+                results.put((n, None, sys.exc_info()))
+
+        while pending or running:
+            if failure is None:
+                for n in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    if not self.deps[n] <= done:
+                        continue
+                    task = self.sequence[n]
+                    pending.remove(n)
+                    yield ('start', task)
+                    if task.exclusive:
+                        # everything before has completed and nothing after
+                        # can have started:
+                        assert not running
+                        updated_state = task.execute(answers, progress_callback, self.phase)
+                        done.add(n)
+                        yield ('done', task, updated_state)
+                        break
+                    running.add(n)
+                    t = threading.Thread(target=worker, args=(n,))
+                    t.daemon = True
+                    t.start()
+                else:
+                    if not running and pending:
+                        # cannot happen unless the dependencies are cyclic
+                        raise RuntimeError("Task scheduler stalled")
+
+            if not running:
+                if failure is not None:
+                    break
+                continue
+
+            n, updated_state, exc_info = results.get()
+            running.remove(n)
+            if exc_info:
+                if failure is None:
+                    failure = exc_info
+                else:
+                    logger.log("DISPATCH: further failure in %s: %s" % (self.sequence[n].fn, exc_info[1]))
+                continue
+            done.add(n)
+            yield ('done', self.sequence[n], updated_state)
+
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
 
 def getPrepSequence(ans, interactive):
     seq = [
         Task(util.getUUID, As(ans), ['installation-uuid']),
         Task(util.getUUID, As(ans), ['control-domain-uuid']),
         Task(util.randomLabelStr, As(ans), ['disk-label-suffix']),
-        Task(inspectTargetDisk, A(ans, 'primary-disk', 'installation-to-overwrite', 'preserve-first-partition','sr-on-primary'), ['target-boot-mode', 'boot-partnum', 'primary-partnum', 'backup-partnum', 'logs-partnum', 'swap-partnum', 'storage-partnum']),
+        Task(inspectTargetDisk, A(ans, 'primary-disk', 'installation-to-overwrite', 'preserve-first-partition','sr-on-primary'), ['target-boot-mode', 'boot-partnum', 'primary-partnum', 'backup-partnum', 'logs-partnum', 'swap-partnum', 'storage-partnum'], resources=['disks']),
         ]
 
+    # Setting the clock may overlap disk preparation, but must be done
+    # before filesystems are created and mounted.
     if ans['time-config-method'] == 'ntp':
-        seq.append(Task(setTimeNTP, A(ans, 'ntp-servers'), []))
+        seq.append(Task(setTimeNTP, A(ans, 'ntp-servers'), [], resources=['clock']))
     elif ans['time-config-method'] == 'manual':
-        seq.append(Task(setTimeManually, A(ans, 'localtime', 'set-time-dialog-dismissed', 'timezone'), []))
+        seq.append(Task(setTimeManually, A(ans, 'localtime', 'set-time-dialog-dismissed', 'timezone'), [], resources=['clock']))
 
     if not interactive:
-        seq.append(Task(verifyRepos, A(ans, 'sources', 'ui'), []))
+        seq.append(Task(verifyRepos, A(ans, 'sources', 'ui'), [], exclusive=True))
     if ans['install-type'] == INSTALL_TYPE_FRESH:
         seq += [
-            Task(removeBlockingVGs, As(ans, 'guest-disks'), []),
-            Task(writeDom0DiskPartitions, A(ans, 'primary-disk', 'target-boot-mode', 'boot-partnum', 'primary-partnum', 'backup-partnum', 'logs-partnum', 'swap-partnum', 'storage-partnum', 'sr-at-end'),[]),
+            Task(removeBlockingVGs, As(ans, 'guest-disks'), [], resources=['disks']),
+            Task(writeDom0DiskPartitions, A(ans, 'primary-disk', 'target-boot-mode', 'boot-partnum', 'primary-partnum', 'backup-partnum', 'logs-partnum', 'swap-partnum', 'storage-partnum', 'sr-at-end'),[], resources=['disks']),
             ]
-        seq.append(Task(writeGuestDiskPartitions, A(ans,'primary-disk', 'guest-disks'), []))
+        seq.append(Task(writeGuestDiskPartitions, A(ans,'primary-disk', 'guest-disks'), [], resources=['disks']))
     elif ans['install-type'] == INSTALL_TYPE_REINSTALL:
         seq.append(Task(getUpgrader, A(ans, 'installation-to-overwrite'), ['upgrader']))
         if 'backup-existing-installation' in ans and ans['backup-existing-installation']:
@@ -151,11 +299,18 @@ def getPrepSequence(ans, interactive):
                         progress_scale=100,
                         pass_progress_callback=True))
     seq += [
-        Task(createDom0DiskFilesystems, A(ans, 'install-type', 'primary-disk', 'target-boot-mode', 'boot-partnum', 'primary-partnum', 'logs-partnum', 'disk-label-suffix'), []),
-        Task(mountVolumes, A(ans, 'primary-disk', 'boot-partnum', 'primary-partnum', 'logs-partnum', 'cleanup', 'target-boot-mode'), ['mounts', 'cleanup']),
+        Task(createDom0DiskFilesystems, A(ans, 'install-type', 'primary-disk', 'target-boot-mode', 'boot-partnum', 'primary-partnum', 'logs-partnum', 'disk-label-suffix'), [], resources=['disks', 'clock']),
+        Task(mountVolumes, A(ans, 'primary-disk', 'boot-partnum', 'primary-partnum', 'logs-partnum', 'cleanup', 'target-boot-mode'), ['mounts', 'cleanup'], resources=['disks', 'clock']),
         ]
     return seq
 
+def getResumeSequence(ans):
+    """ Prep sequence used when resuming from a checkpoint: the target disk
+    has already been partitioned and formatted, so only remount it. """
+    return [
+        Task(mountVolumes, A(ans, 'primary-disk', 'boot-partnum', 'primary-partnum', 'logs-partnum', 'cleanup', 'target-boot-mode'), ['mounts', 'cleanup']),
+        ]
+
 def getMainRepoSequence(ans, repos):
     seq = []
     seq.append(Task(repository.installFromRepos, lambda a: [repos] + [a.get('mounts')], [],
@@ -178,34 +333,51 @@ def getRepoSequence(ans, repos):
         seq.append(Task(repo.getBranding, A(ans, 'mounts', 'branding'), ['branding']))
     return seq
 
-def getFinalisationSequence(ans):
+def getFinalisationSequence(ans, checkpoint=None):
+    # Resource tags used below, for state shared through the target root
+    # filesystem rather than through labels:
+    #  'chroot-mounts': /dev, /proc, /sys bind mounts into the target root;
+    #                   held by every task which runs a command chrooted
+    #                   there or mounts anything under it
+    #  'systemd-units': unit enablement via systemctl in the target root
+    #  'initrd-inputs': files which dracut picks up when building an initrd
+    #  'swap': the swap partition or file, and its fstab entry
     seq = [
-        Task(writeResolvConf, A(ans, 'mounts', 'manual-hostname', 'manual-nameservers'), []),
-        Task(writeMachineID, A(ans, 'mounts'), []),
-        Task(writeKeyboardConfiguration, A(ans, 'mounts', 'keymap'), []),
-        Task(configureNetworking, A(ans, 'mounts', 'net-admin-interface', 'net-admin-bridge', 'net-admin-configuration', 'manual-hostname', 'manual-nameservers', 'network-hardware', 'preserve-settings', 'network-backend'), []),
-        Task(prepareSwapfile, A(ans, 'mounts', 'primary-disk', 'swap-partnum', 'disk-label-suffix'), []),
-        Task(writeFstab, A(ans, 'mounts', 'target-boot-mode', 'primary-disk', 'logs-partnum', 'swap-partnum', 'disk-label-suffix'), []),
-        Task(enableAgent, A(ans, 'mounts', 'network-backend', 'services'), []),
-        Task(configureCC, A(ans, 'mounts'), []),
+        Task(writeResolvConf, A(ans, 'mounts', 'manual-hostname', 'manual-nameservers'), [],
+             resources=['initrd-inputs']),
+        Task(writeMachineID, A(ans, 'mounts'), [], resources=['chroot-mounts', 'initrd-inputs']),
+        Task(writeKeyboardConfiguration, A(ans, 'mounts', 'keymap'), [], resources=['initrd-inputs']),
+        Task(configureNetworking, A(ans, 'mounts', 'net-admin-interface', 'net-admin-bridge', 'net-admin-configuration', 'manual-hostname', 'manual-nameservers', 'network-hardware', 'preserve-settings', 'network-backend'), [],
+             resources=['chroot-mounts', 'systemd-units', 'initrd-inputs']),
+        Task(prepareSwapfile, A(ans, 'mounts', 'primary-disk', 'swap-partnum', 'disk-label-suffix'), [],
+             resources=['chroot-mounts', 'swap']),
+        Task(writeFstab, A(ans, 'mounts', 'target-boot-mode', 'primary-disk', 'logs-partnum', 'swap-partnum', 'disk-label-suffix'), [],
+             resources=['swap', 'initrd-inputs']),
+        Task(enableAgent, A(ans, 'mounts', 'network-backend', 'services'), [],
+             resources=['chroot-mounts', 'systemd-units']),
+        Task(configureCC, A(ans, 'mounts'), [], resources=['chroot-mounts', 'systemd-units']),
         Task(configureLogrotate, A(ans, 'mounts', 'primary-disk', 'logs-partnum'), []),
         Task(writeInventory, A(ans, 'installation-uuid', 'control-domain-uuid', 'mounts', 'primary-disk',
                                'backup-partnum', 'storage-partnum', 'guest-disks', 'net-admin-bridge',
                                'branding', 'net-admin-configuration', 'host-config', 'install-type'), []),
         Task(writeXencommons, A(ans, 'control-domain-uuid', 'mounts'), []),
-        Task(configureISCSI, A(ans, 'mounts', 'primary-disk'), []),
+        Task(configureISCSI, A(ans, 'mounts', 'primary-disk'), [],
+             resources=['chroot-mounts', 'systemd-units', 'initrd-inputs']),
         Task(mkinitrd, A(ans, 'mounts', 'primary-disk', 'primary-partnum',
-                              'fcoe-interfaces'), []),
-        Task(prepFallback, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), []),
+                              'fcoe-interfaces'), [], resources=['chroot-mounts', 'initrd-inputs']),
+        Task(prepFallback, A(ans, 'mounts', 'primary-disk', 'primary-partnum'), [],
+             resources=['chroot-mounts', 'initrd-inputs']),
         Task(installBootLoader, A(ans, 'mounts', 'primary-disk',
                                   'boot-partnum', 'primary-partnum', 'target-boot-mode', 'branding',
                                   'disk-label-suffix', 'bootloader-location', 'write-boot-entry', 'install-type',
-                                  'serial-console', 'boot-serial', 'host-config', 'fcoe-interfaces'), []),
+                                  'serial-console', 'boot-serial', 'host-config', 'fcoe-interfaces'), [],
+             resources=['chroot-mounts']),
         Task(touchSshAuthorizedKeys, A(ans, 'mounts'), []),
-        Task(setRootPassword, A(ans, 'mounts', 'root-password'), [], args_sensitive=True),
-        Task(setTimeZone, A(ans, 'mounts', 'timezone'), []),
-        Task(writei18n, A(ans, 'mounts'), []),
-        Task(configureMCELog, A(ans, 'mounts'), []),
+        Task(setRootPassword, A(ans, 'mounts', 'root-password'), [], args_sensitive=True,
+             resources=['chroot-mounts']),
+        Task(setTimeZone, A(ans, 'mounts', 'timezone'), [], resources=['initrd-inputs']),
+        Task(writei18n, A(ans, 'mounts'), [], resources=['initrd-inputs']),
+        Task(configureMCELog, A(ans, 'mounts'), [], resources=['chroot-mounts', 'systemd-units']),
         ]
 
     # on fresh installs, prepare the storage repository as required:
@@ -215,7 +387,8 @@ def getFinalisationSequence(ans):
             Task(configureSRMultipathing, A(ans, 'mounts', 'primary-disk'), []),
             ]
     if ans['time-config-method'] == 'ntp':
-        seq.append(Task(configureNTP, A(ans, 'mounts', 'ntp-servers'), []))
+        seq.append(Task(configureNTP, A(ans, 'mounts', 'ntp-servers'), [],
+                        resources=['chroot-mounts', 'systemd-units']))
     # complete upgrade if appropriate:
     if ans['install-type'] == constants.INSTALL_TYPE_REINSTALL:
         seq.append( Task(completeUpgrade, lambda a: [ a['upgrader'] ] + [ a[x] for x in a['upgrader'].completeUpgradeArgs ], []) )
@@ -223,13 +396,166 @@ def getFinalisationSequence(ans):
     # run the users's scripts
     seq.append( Task(scripts.run_scripts, lambda a: ['filesystem-populated',  a['mounts']['root']], []) )
 
-    seq.append(Task(umountVolumes, A(ans, 'mounts', 'cleanup'), ['cleanup']))
+    # the installation can no longer be resumed once volumes are unmounted:
+    if checkpoint:
+        seq.append(Task(checkpoint.discard, A(ans, 'mounts'), [], exclusive=True))
+
+    seq.append(Task(umountVolumes, A(ans, 'mounts', 'cleanup'), ['cleanup'], exclusive=True))
     if ans['target-boot-mode'] == TARGET_BOOT_MODE_LEGACY:
         seq.append(Task(setActiveDiskPartition, A(ans, 'primary-disk', 'boot-partnum', 'primary-partnum'), []))
-    seq.append(Task(writeLog, A(ans, 'primary-disk', 'primary-partnum', 'logs-partnum'), []))
+    seq.append(Task(writeLog, A(ans, 'primary-disk', 'primary-partnum', 'logs-partnum'), [], exclusive=True))
 
     return seq
 
+class Checkpoint(object):
+    """
+    Records how far a fresh installation got, on the logs partition of the
+    target, so that a failed installation can be resumed without
+    repartitioning and reinstalling packages.  For each phase, the number of
+    leading tasks that completed is kept, together with the state the tasks
+    produced, and a digest of each of the answers the installation was
+    started with, so that it is only resumed with the same answers.
+    """
+
+    # answers which do not describe the installation itself
+    IGNORED_ANSWERS = ['resume', 'ui', 'cleanup', 'mounts', 'installed-repos']
+
+    def __init__(self, answers, state=None):
+        if state is None:
+            salt = os.urandom(16).encode('hex')
+            state = {'primary-disk': answers['primary-disk'],
+                     'completed': {},
+                     'answers': {},
+                     'installed-repos': [],
+                     'answers-salt': salt,
+                     'answers-digests': self._digestAnswers(answers, salt)}
+        self.state = state
+        self.discarded = False
+
+    @classmethod
+    def _digestAnswers(cls, answers, salt):
+        """ Return salted digests of answers, so that no answer, e.g. the
+        root password, is readable from the checkpoint. """
+        def serialisable(o):
+            # e.g. network interfaces: compare their attributes
+            if hasattr(o, '__dict__'):
+                return o.__dict__
+            raise TypeError("%r cannot be compared" % o)
+
+        digests = {}
+        for k, v in answers.items():
+            if k in cls.IGNORED_ANSWERS:
+                continue
+            try:
+                value = json.dumps(v, sort_keys=True, default=serialisable)
+            except (TypeError, ValueError) as e:
+                logger.log("Not checking answer %s on resume: %s" % (k, e))
+                continue
+            digests[k] = hashlib.sha256("%s\0%s\0%s" % (salt, k, value)).hexdigest()
+        return digests
+
+    def differingAnswers(self, answers):
+        """ Return the keys of answers which differ from those the
+        installation was started with. """
+        saved = self.state['answers-digests']
+        current = self._digestAnswers(answers, self.state['answers-salt'])
+        return sorted(k for k in set(saved) | set(current) if saved.get(k) != current.get(k))
+
+    def __repr__(self):
+        return "<Checkpoint: %s>" % self.state['completed']
+
+    def completed(self, phase):
+        return self.state['completed'].get(phase, 0)
+
+    def resumeAnswers(self):
+        return self.state['answers']
+
+    def restoreInstalledRepos(self, installed_repos, repos):
+        """ Record in installed_repos those of repos installed before the
+        checkpoint, which must all be among them. """
+        for repo in repos:
+            if str(repo) in self.state['installed-repos']:
+                installed_repos[str(repo)] = repo
+        if sorted(installed_repos.keys()) != sorted(self.state['installed-repos']):
+            raise RuntimeError("Repositories installed before the checkpoint are not available: %s" %
+                               ", ".join(set(self.state['installed-repos']) - set(installed_repos.keys())))
+
+    def update(self, phase, completed, updated_state, mounts):
+        for k, v in updated_state.items():
+            if k in ['mounts', 'cleanup']:
+                continue
+            # repositories are recorded by name, and found again on resume
+            if k == 'installed-repos':
+                self.state['installed-repos'] = sorted(v.keys())
+                continue
+            try:
+                json.dumps(v)
+            except (TypeError, ValueError):
+                continue
+            self.state['answers'][k] = v
+        self.state['completed'][phase] = completed
+
+        # nothing can be written until the target volumes are mounted
+        if self.discarded or not mounts or 'logs' not in mounts:
+            return
+        path = os.path.join(mounts['logs'], constants.CHECKPOINT_FILE)
+        try:
+            # package writes were not synced by yum: they must reach the
+            # disk before a resume can skip the tasks which made them
+            if constants.RELAXED_DURABILITY:
+                util.runCmd2(['sync'])
+            with open(path + '.new', 'w') as f:
+                json.dump(self.state, f)
+            os.rename(path + '.new', path)
+        except Exception as e:
+            logger.log("Failed to write checkpoint: %s" % e)
+
+    def discard(self, mounts):
+        self.discarded = True
+        if 'logs' in mounts:
+            path = os.path.join(mounts['logs'], constants.CHECKPOINT_FILE)
+            if os.path.exists(path):
+                os.unlink(path)
+
+    @classmethod
+    def load(cls, answers):
+        """ Return the checkpoint left on the primary disk by a failed
+        installation, or None if there is no usable one. """
+        disk = answers['primary-disk']
+        try:
+            _, _, _, _, logs_partnum, _, _ = inspectTargetDisk(
+                disk, None, answers['preserve-first-partition'], answers['sr-on-primary'])
+            if not PartitionTool(disk).getPartition(logs_partnum):
+                logger.log("No logs partition on %s: cannot resume" % disk)
+                return None
+            mount = util.TempMount(partitionDevice(disk, logs_partnum), 'checkpoint-', ['ro'])
+            try:
+                path = os.path.join(mount.mount_point, constants.CHECKPOINT_FILE)
+                if not os.path.exists(path):
+                    logger.log("No checkpoint found on %s: cannot resume" % disk)
+                    return None
+                with open(path) as f:
+                    state = json.load(f)
+            finally:
+                mount.unmount()
+        except Exception as e:
+            logger.log("Failed to read checkpoint: %s" % e)
+            return None
+
+        state.setdefault('installed-repos', [])
+        if state.get('primary-disk') != disk or not state['completed'].get('prep') or \
+                'answers-digests' not in state:
+            logger.log("Checkpoint on %s does not match this installation" % disk)
+            return None
+        checkpoint = cls(answers, state)
+        differing = checkpoint.differingAnswers(answers)
+        if differing:
+            logger.log("Not resuming: answers differ from those of the checkpointed installation: %s" %
+                       ", ".join(differing))
+            return None
+        logger.log("Resuming installation from checkpoint %s" % state['completed'])
+        return checkpoint
+
 def prettyLogAnswers(answers):
     for a in answers:
         if a == 'root-password':
@@ -240,19 +566,25 @@ def prettyLogAnswers(answers):
             val = answers[a]
         logger.log("%s := %s %s" % (a, val, type(val)))
 
-def executeSequence(sequence, seq_name, answers, ui, cleanup):
+def executeSequence(sequence, seq_name, answers, ui, cleanup, parallel=False,
+                    checkpoint=None, phase=None):
     answers['cleanup'] = []
     answers['ui'] = ui
 
+    skipped = 0
+    if checkpoint:
+        skipped = checkpoint.completed(phase)
+        if skipped > 0:
+            logger.log("DISPATCH: skipping %d tasks completed before the checkpoint" % skipped)
+            sequence = sequence[skipped:]
+    if len(sequence) == 0:
+        return
+
     progress_total = reduce(lambda x, y: x + y,
                             [task.progress_scale for task in sequence])
 
-    pd = None
-    if ui:
-        pd = ui.progress.initProgressDialog(
-            "Installing %s" % MY_PRODUCT_BRAND,
-            seq_name, progress_total
-            )
+    pd = progressbus.ProgressBus("Installing %s" % MY_PRODUCT_BRAND,
+                                 seq_name, progress_total, ui)
     logger.log("DISPATCH: NEW PHASE: %s" % seq_name)
 
     def doCleanup(actions):
@@ -262,42 +594,80 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
             except:
                 logger.log("FAILED to perform cleanup action %s" % tag)
 
-    def progressCallback(x):
-        if ui:
-            ui.progress.displayProgressDialog(current + x, pd)
+    def progressCallback(x, text=None):
+        pd.update(current + x, text)
+
+    def updateState(updated_state):
+        if len(updated_state) > 0:
+            logger.log(
+                "DISPATCH: Updated state: %s" %
+                str.join("; ", ["%s -> %s" % (v, updated_state[v]) for v in updated_state.keys()])
+                )
+            for state_item in updated_state:
+                answers[state_item] = updated_state[state_item]
+
+    completed = set()
+    def taskCompleted(item, updated_state):
+        updateState(updated_state)
+        if checkpoint:
+            completed.add(sequence.index(item))
+            leading = 0
+            while leading in completed:
+                leading += 1
+            checkpoint.update(phase, skipped + leading, updated_state, answers.get('mounts'))
 
     try:
         current = 0
-        for item in sequence:
-            if pd:
+        if parallel:
+            scheduler = TaskScheduler(sequence, constants.MAX_PARALLEL_TASKS, seq_name)
+            for event in scheduler.run(answers, progressCallback):
+                if event[0] == 'start':
+                    pd.update(current, event[1].progress_text)
+                else:
+                    _, item, updated_state = event
+                    taskCompleted(item, updated_state)
+                    current = current + item.progress_scale
+                    pd.update(current)
+        else:
+            for item in sequence:
                 if item.progress_text:
                     text = item.progress_text
                 else:
                     text = seq_name
 
-                ui.progress.displayProgressDialog(current, pd, updated_text=text)
-            updated_state = item.execute(answers, progressCallback)
-            if len(updated_state) > 0:
-                logger.log(
-                    "DISPATCH: Updated state: %s" %
-                    str.join("; ", ["%s -> %s" % (v, updated_state[v]) for v in updated_state.keys()])
-                    )
-                for state_item in updated_state:
-                    answers[state_item] = updated_state[state_item]
-
-            current = current + item.progress_scale
+                pd.update(current, text)
+                updated_state = item.execute(answers, progressCallback, seq_name)
+                taskCompleted(item, updated_state)
+
+                current = current + item.progress_scale
     except:
         doCleanup(answers['cleanup'])
         raise
     else:
-        if ui and pd:
-            ui.progress.clearModelessDialog()
+        pd.finish()
 
         if cleanup:
             doCleanup(answers['cleanup'])
             del answers['cleanup']
 
+def logTaskTimings(count=10):
+    """ Log a table of the slowest tasks executed so far. """
+    timeline = sorted(xelogging.task_timeline, key=lambda r: r['duration'], reverse=True)
+    logger.log("TASK TIMINGS: %d slowest of %d tasks, %.1fs in total:" %
+               (min(count, len(timeline)), len(timeline),
+                sum(r['duration'] for r in timeline)))
+    for r in timeline[:count]:
+        logger.log("  %9.3fs  %-9s  %-32s  %s" % (r['duration'], r['status'], r['phase'], r['task']))
+
 def performInstallation(answers, ui_package, interactive):
+    try:
+        doInstallation(answers, ui_package, interactive)
+    finally:
+        repository.registry.release()
+        repository.payload_cache.clear()
+        logTaskTimings()
+
+def doInstallation(answers, ui_package, interactive):
     logger.log("INPUT ANSWERS DICTIONARY:")
     prettyLogAnswers(answers)
     logger.log("SCRIPTS DICTIONARY:")
@@ -360,21 +730,54 @@ def performInstallation(answers, ui_package, interactive):
         assert answers['net-admin-interface'].startswith("eth")
         answers['net-admin-bridge'] = "xenbr%s" % answers['net-admin-interface'][3:]
 
+    answers['installed-repos'] = {}
+
+    # Only fresh installations can be resumed, as upgrades modify the
+    # existing installation before the target is prepared.
+    checkpoint = None
+    if answers['install-type'] == INSTALL_TYPE_FRESH:
+        if answers.get('resume'):
+            checkpoint = Checkpoint.load(answers)
+        if checkpoint:
+            answers.update(checkpoint.resumeAnswers())
+        else:
+            checkpoint = Checkpoint(answers)
+
+    # Repository definitions, in the order their repositories are installed:
+    repo_defs = []
+    # A list of sources coming from the answerfile
+    if 'sources' in answers:
+        repo_defs += [(i['media'], i['address']) for i in answers['sources']]
+    # A single source coming from an interactive install
+    if 'source-media' in answers and 'source-address' in answers:
+        repo_defs.append((answers['source-media'], answers['source-address']))
+    repo_defs += answers['extra-repos']
+
+    # Fetch repository metadata while the target is being prepared:
+    repo_loader = repository.RepositoryLoader(repo_defs)
+
     # perform installation:
-    prep_seq = getPrepSequence(answers, interactive)
     answers_pristine = answers.copy()
-    executeSequence(prep_seq, "Preparing for installation...", answers, ui_package, False)
+    # media found while choosing the source may be on the target disk
+    repository.registry.releaseMedia()
+    if checkpoint and checkpoint.completed('prep'):
+        prep_seq = getResumeSequence(answers)
+        executeSequence(prep_seq, "Preparing for installation...", answers, ui_package, False)
+    else:
+        prep_seq = getPrepSequence(answers, interactive)
+        executeSequence(prep_seq, "Preparing for installation...", answers, ui_package, False, parallel=True,
+                        checkpoint=checkpoint, phase='prep')
 
     # install from main repositories:
     def handleMainRepos(main_repositories, ans):
         repo_seq = getMainRepoSequence(ans, main_repositories)
-        executeSequence(repo_seq, "Reading package information...", ans, ui_package, False)
+        executeSequence(repo_seq, "Reading package information...", ans, ui_package, False,
+                        checkpoint=checkpoint, phase='main-repos')
 
     def handleRepos(repos, ans):
         repo_seq = getRepoSequence(ans, repos)
-        executeSequence(repo_seq, "Reading package information...", ans, ui_package, False)
-
-    answers['installed-repos'] = {}
+        executeSequence(repo_seq, "Reading package information...", ans, ui_package, False,
+                        checkpoint=checkpoint, phase='update-repos')
 
     # A list needs to be used rather than a set since the order of updates is
     # important.  However, since the same repository might exist in multiple
@@ -400,24 +803,17 @@ def performInstallation(answers, ui_package, interactive):
                 else:
                     repo_list.append(repo)
 
-    # A list of sources coming from the answerfile
-    if 'sources' in answers_pristine:
-        for i in answers_pristine['sources']:
-            repos = repository.repositoriesFromDefinition(i['media'], i['address'])
-            add_repos(main_repositories, update_repositories, repos)
-
-    # A single source coming from an interactive install
-    if 'source-media' in answers_pristine and 'source-address' in answers_pristine:
-        repos = repository.repositoriesFromDefinition(answers_pristine['source-media'], answers_pristine['source-address'])
-        add_repos(main_repositories, update_repositories, repos)
-
-    for media, address in answers_pristine['extra-repos']:
-        repos = repository.repositoriesFromDefinition(media, address)
+    for media, address in repo_defs:
+        repos = repo_loader.repositoriesFromDefinition(media, address)
         add_repos(main_repositories, update_repositories, repos)
 
     if not main_repositories or main_repositories[0].identifier() != MAIN_REPOSITORY_NAME:
         raise RuntimeError("No main repository found")
 
+    if checkpoint:
+        checkpoint.restoreInstalledRepos(answers['installed-repos'],
+                                         main_repositories + update_repositories)
+
     handleMainRepos(main_repositories, answers)
     if update_repositories:
         handleRepos(update_repositories, answers)
@@ -442,15 +838,17 @@ def performInstallation(answers, ui_package, interactive):
             repos = set([repo for repo in repos if str(repo) not in answers['installed-repos']])
             if not repos:
                 continue
-            handleRepos(repos, answers)
+            repo_seq = getRepoSequence(answers, repos)
+            executeSequence(repo_seq, "Reading package information...", answers, ui_package, False)
 
             for r in repos:
                 if r.accessor().canEject():
                     r.accessor().eject()
 
     # complete the installation:
-    fin_seq = getFinalisationSequence(answers)
-    executeSequence(fin_seq, "Completing installation...", answers, ui_package, True)
+    fin_seq = getFinalisationSequence(answers, checkpoint)
+    executeSequence(fin_seq, "Completing installation...", answers, ui_package, True, parallel=True,
+                    checkpoint=checkpoint, phase='finalisation')
 
 def configureMCELog(mounts):
     """Disable mcelog on unsupported processors."""
@@ -774,7 +1172,9 @@ def make_free_space(mount, required):
 # Create dom0 disk file-systems:
 
 def createDom0DiskFilesystems(install_type, disk, target_boot_mode, boot_partnum, primary_partnum, logs_partnum, disk_label_suffix):
-    if target_boot_mode == TARGET_BOOT_MODE_UEFI:
+    # The partitions are independent, so their filesystems are created
+    # concurrently.
+    def createBootFilesystem():
         partition = partitionDevice(disk, boot_partnum)
         try:
             util.mkfs(bootfs_type, partition,
@@ -782,16 +1182,15 @@ def createDom0DiskFilesystems(install_type, disk, target_boot_mode, boot_partnum
         except Exception as e:
             raise RuntimeError("Failed to create boot filesystem: %s" % e)
 
-    partition = partitionDevice(disk, primary_partnum)
-    try:
-        util.mkfs(rootfs_type, partition,
-                  ["-L", rootfs_label%disk_label_suffix])
-    except Exception as e:
-        raise RuntimeError("Failed to create root filesystem: %s" % e)
+    def createRootFilesystem():
+        partition = partitionDevice(disk, primary_partnum)
+        try:
+            util.mkfs(rootfs_type, partition,
+                      ["-L", rootfs_label%disk_label_suffix])
+        except Exception as e:
+            raise RuntimeError("Failed to create root filesystem: %s" % e)
 
-    tool = PartitionTool(disk)
-    logs_partition = tool.getPartition(logs_partnum)
-    if logs_partition:
+    def createLogsFilesystem():
         run_mkfs = True
 
         # If the log partition already exists and is formatted correctly,
@@ -828,6 +1227,21 @@ def createDom0DiskFilesystems(install_type, disk, target_boot_mode, boot_partnum
             finally:
                 mount.unmount()
 
+    jobs = []
+    if target_boot_mode == TARGET_BOOT_MODE_UEFI:
+        jobs.append(createBootFilesystem)
+    jobs.append(createRootFilesystem)
+    tool = PartitionTool(disk)
+    if tool.getPartition(logs_partnum):
+        jobs.append(createLogsFilesystem)
+
+    failures = [exc_info for _, exc_info in util.parallelMap(lambda job: job(), jobs, len(jobs))
+                if exc_info]
+    if len(failures) == 1:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    elif failures:
+        raise RuntimeError("\n".join(str(exc_info[1]) for exc_info in failures))
+
 def __mkinitrd(mounts, partition, package, kernel_version, fcoe_interfaces):
 
     try:
@@ -1250,6 +1664,9 @@ def umountVolumes(mounts, cleanup, force=False):
                 not tag.startswith("umount-%s" % os.path.join(mounts['root'], 'mnt')) and
                 not tag.startswith("umount-%s" % mounts['boot']))
 
+    if constants.RELAXED_DURABILITY:
+        # packages were installed without syncing
+        util.runCmd2(['sync'])
     util.umount(os.path.join(mounts['root'], 'mnt'))
     util.umount(constants.EXTRA_SCRIPTS_DIR)
     if 'esp' in mounts:
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Decompresses a gz and a bz2 stream through cpiofile._Stream, as
+# _parse_repodata and CPIO archive reading do, with small and large reads:
+#
+#   benchmarks/cpio_stream.py [--megabytes N] [--formats gz,bz2]
+#                             [--data xml,hex] [--reads 512,16384,1048576]
+#
+# "xml" data compresses by a few hundred to one, like primary.xml; "hex"
+# compresses by about two to one.  Run it from an older checkout to get
+# the figures to compare with.
+
+import bz2
+import gzip
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cpiofile
+
+def xmlBlock():
+    return ''.join('<package type="rpm"><name>pkg%d</name>'
+                   '<location href="Packages/pkg%d.rpm"/></package>\n' % (i % 50, i % 50)
+                   for i in range(10000))
+
+def hexBlock():
+    return os.urandom(524288).encode('hex')
+
+def writeStream(path, fmt, block, megabytes):
+    if fmt == 'gz':
+        f = gzip.open(path, 'wb')
+    else:
+        f = bz2.BZ2File(path, 'wb')
+    written = 0
+    while written < megabytes * 1024 * 1024:
+        f.write(block)
+        written += len(block)
+    f.close()
+    return written
+
+def readStream(path, fmt, read_size):
+    with open(path, 'rb') as fileobj:
+        stream = cpiofile._Stream("", "r", fmt, fileobj, 20*512)
+        total = 0
+        while True:
+            data = stream.read(read_size)
+            if not data:
+                break
+            total += len(data)
+        stream.close()
+    return total
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--megabytes', type='int', default=200)
+    parser.add_option('--formats', default='gz,bz2')
+    parser.add_option('--data', default='xml,hex')
+    parser.add_option('--reads', default='512,16384,1048576')
+    opts, _ = parser.parse_args()
+
+    blocks = {'xml': xmlBlock, 'hex': hexBlock}
+    fd, path = tempfile.mkstemp(prefix='stream-')
+    os.close(fd)
+    try:
+        for fmt in opts.formats.split(','):
+            for kind in opts.data.split(','):
+                size = writeStream(path, fmt, blocks[kind](), opts.megabytes)
+                print "%s %s: %d MB compressed to %.1f MB" % (
+                    fmt, kind, size / 1048576, os.path.getsize(path) / 1048576.0)
+                for read_size in [int(r) for r in opts.reads.split(',')]:
+                    start = time.time()
+                    assert readStream(path, fmt, read_size) == size
+                    print "  read(%d): %.2fs" % (read_size, time.time() - start)
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Checksums a directory of synthetic packages the way RPMPackage.check
+# used to (10 MB read() calls) and with hashLocalFile at several block
+# sizes, reporting throughput and how much the page cache grew:
+#
+#   benchmarks/hash_local.py [--dir DIR] [--megabytes N] [--threads N]
+#
+# The files are evicted from the page cache before each pass, so put them
+# (--dir) on a disk rather than on tmpfs to see the cache growth.
+
+import hashlib
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import repository
+import util
+
+def makePackages(directory, total_mb):
+    """ Write packages of between 16 KB and 16 MB, mostly small ones as
+    in a real repository, until total_mb is reached. """
+    rand = random.Random(0)
+    paths = []
+    remaining = total_mb * 1024 * 1024
+    chunk = os.urandom(1048576)
+    while remaining > 0:
+        size = min(remaining, int(16384 * 2 ** rand.uniform(0, 10)))
+        path = os.path.join(directory, 'pkg%05d.rpm' % len(paths))
+        with open(path, 'wb') as f:
+            for start in range(0, size, len(chunk)):
+                f.write(chunk[:min(len(chunk), size - start)])
+            # dirty pages cannot be evicted before each pass
+            f.flush()
+            os.fsync(f.fileno())
+        paths.append(path)
+        remaining -= size
+    return paths
+
+def hashByRead(path):
+    m = hashlib.sha256()
+    with open(path, 'r') as f:
+        while True:
+            data = f.read(10485760)
+            if data == '':
+                break
+            m.update(data)
+    return m.hexdigest()
+
+def pageCacheKB():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('Cached:'):
+                return int(line.split()[1])
+
+def evict(paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        util.fadvise(fd, 0, 0, util.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+def run(label, fn, paths, threads, total_mb):
+    evict(paths)
+    cached = pageCacheKB()
+    start = time.time()
+    results = util.parallelMap(fn, paths, threads)
+    elapsed = time.time() - start
+    growth = (pageCacheKB() - cached) / 1024
+    for _, exc_info in results:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    print "%-18s %6.2fs  %6.1f MB/s  page cache %+5d MB" % (
+        label, elapsed, total_mb / elapsed, growth)
+    return [result for result, _ in results]
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--dir', default=None,
+                      help="directory for the packages (default: a new one in /tmp)")
+    parser.add_option('--megabytes', type='int', default=512)
+    parser.add_option('--threads', type='int', default=8)
+    opts, _ = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='hash-bench-', dir=opts.dir)
+    try:
+        paths = makePackages(directory, opts.megabytes)
+        print "%d packages, %d MB, %d threads" % (len(paths), opts.megabytes, opts.threads)
+
+        expected = run('read(10M)', hashByRead, paths, opts.threads, opts.megabytes)
+        for block_size in [65536, 262144, 1048576, 4194304]:
+            repository.HASH_BLOCK_SIZE = block_size
+            # parallelMap starts new threads, so each gets a new buffer
+            sums = run('readinto(%dK)' % (block_size / 1024),
+                       lambda path: repository.hashLocalFile(path, os.path.getsize(path)),
+                       paths, opts.threads, opts.megabytes)
+            assert sums == expected
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
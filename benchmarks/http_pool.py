@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Fetches a few thousand small files from a local keep-alive HTTP server,
+# with a new urllib2 connection per file as URLAccessor used to, and
+# through URLAccessor and its connection pool:
+#
+#   benchmarks/http_pool.py [--files N] [--rtt MS] [--threads N]
+#
+# --rtt delays each new connection and each request, standing in for the
+# round trips of a remote server.
+
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import repository
+import util
+
+class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in as few segments as a real server would; with
+    # a write per header line, delayed ACKs stall keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.server.connected()
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+
+    def handle_one_request(self):
+        time.sleep(self.server.rtt)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, path.lstrip('/'))
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, directory, rtt):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.directory = directory
+        self.rtt = rtt
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+        # the TCP handshake
+        time.sleep(self.rtt)
+
+def fetchAll(fetch, names, threads):
+    """ Fetch names on threads, as Repository.check does, returning the
+    time taken. """
+    start = time.time()
+    for _, exc_info in util.parallelMap(fetch, names, threads):
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return time.time() - start
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--files', type='int', default=2000)
+    parser.add_option('--size', type='int', default=4096, help="bytes per file")
+    parser.add_option('--rtt', type='float', default=0, help="milliseconds")
+    parser.add_option('--threads', type='int', default=8)
+    opts, _ = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='http-bench-')
+    try:
+        names = ['f%05d' % i for i in range(opts.files)]
+        for name in names:
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(os.urandom(opts.size))
+
+        server = Server(directory, opts.rtt / 1000.0)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        base = 'http://127.0.0.1:%d' % server.server_address[1]
+
+        def viaUrllib2(name):
+            f = urllib2.urlopen(base + '/' + name)
+            f.read()
+            f.close()
+
+        accessor = repository.URLAccessor(util.URL(base))
+        def viaAccessor(name):
+            f = accessor.openAddress(name)
+            f.read()
+            f.close()
+
+        print "%d files of %d bytes, %gms round trip, %d threads" % (
+            opts.files, opts.size, opts.rtt, opts.threads)
+        for label, fetch in [('urllib2', viaUrllib2), ('pool', viaAccessor)]:
+            server.connections = 0
+            elapsed = fetchAll(fetch, names, opts.threads)
+            print "%-8s %6.2fs  %5d connections" % (label, elapsed, server.connections)
+        server.shutdown()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
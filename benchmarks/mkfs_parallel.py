@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Compares creating the dom0 filesystems one after another with creating
+# them concurrently, as createDom0DiskFilesystems does, on loop devices.
+# Must be run as root, from the installer source directory or with it on
+# the path:
+#
+#   benchmarks/mkfs_parallel.py [--dir DIR] [--root-size MB] [--logs-size MB]
+#
+# The backing files are sparse; put them (--dir) on the kind of storage to
+# be measured, as mkfs timing depends on it far more than on this code.
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import constants
+import util
+
+def createLoopDevice(path, size_mb):
+    with open(path, 'w') as f:
+        f.truncate(size_mb * 1024 * 1024)
+    rc, out = util.runCmd2(['losetup', '-f', '--show', path], with_stdout=True)
+    if rc != 0:
+        raise RuntimeError("losetup failed for %s" % path)
+    return out.strip()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--dir', default=None,
+                      help="directory for the backing files (default: a new one in /tmp)")
+    parser.add_option('--boot-size', type='int', default=constants.boot_size)
+    parser.add_option('--root-size', type='int', default=constants.root_gpt_size)
+    parser.add_option('--logs-size', type='int', default=constants.logs_size)
+    parser.add_option('--runs', type='int', default=3)
+    opts, _ = parser.parse_args()
+
+    partitions = [('boot', constants.bootfs_type, opts.boot_size, ['-n', 'BOOT-BENCH']),
+                  ('root', constants.rootfs_type, opts.root_size, ['-L', 'root-bench']),
+                  ('logs', constants.logsfs_type, opts.logs_size, ['-L', 'logs-bench'])]
+    # the installer has every mkfs; a build host may lack some of them
+    missing = [p for p in partitions if util.runCmd2(['which', 'mkfs.%s' % p[1]]) != 0]
+    for name, fstype, _, _ in missing:
+        print "Skipping the %s partition: no mkfs.%s" % (name, fstype)
+    partitions = [p for p in partitions if p not in missing]
+
+    directory = opts.dir or tempfile.mkdtemp(prefix='mkfs-bench-')
+    devices = []
+    try:
+        for name, _, size, _ in partitions:
+            devices.append(createLoopDevice(os.path.join(directory, name), size))
+        jobs = [(fstype, device, options)
+                for (_, fstype, _, options), device in zip(partitions, devices)]
+        mkfs = lambda job: util.mkfs(*job)
+
+        for run in range(opts.runs):
+            start = time.time()
+            for job in jobs:
+                mkfs(job)
+            serial = time.time() - start
+
+            start = time.time()
+            for _, exc_info in util.parallelMap(mkfs, jobs, len(jobs)):
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            parallel = time.time() - start
+
+            print "run %d: serial %.2fs, parallel %.2fs" % (run + 1, serial, parallel)
+    finally:
+        for device in devices:
+            util.runCmd2(['losetup', '-d', device])
+        if opts.dir:
+            for name, _, _, _ in partitions:
+                if os.path.exists(os.path.join(directory, name)):
+                    os.unlink(os.path.join(directory, name))
+        else:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Time and peak memory of reading the package list from a synthetic
+# primary.xml.gz, with the minidom parser _parse_repodata used to have and
+# with iterPrimaryPackages:
+#
+#   benchmarks/parse_primary.py [--packages N]
+#
+# Each parser runs in a child process so that its peak RSS is its own.
+
+import gzip
+import optparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from xml.dom.minidom import parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cpiofile
+import repository
+
+PACKAGE = """<package type="rpm">
+  <name>pkg%(n)d</name>
+  <arch>x86_64</arch>
+  <version epoch="0" ver="1.%(n)d" rel="1"/>
+  <checksum type="sha256" pkgid="YES">%(sum)s</checksum>
+  <summary>Synthetic package %(n)d</summary>
+  <description>A package generated to measure parsing of primary.xml, with a
+description of a few lines like those of real packages.</description>
+  <packager>Builder</packager>
+  <url>http://example.com/</url>
+  <time file="1500000000" build="1500000000"/>
+  <size package="%(size)d" installed="%(installed)d" archive="%(installed)d"/>
+  <location href="Packages/pkg%(n)d-1.%(n)d-1.x86_64.rpm"/>
+  <format>
+    <rpm:license>GPL</rpm:license>
+    <rpm:group>System Environment/Base</rpm:group>
+    <rpm:provides>
+      <rpm:entry name="pkg%(n)d" flags="EQ" epoch="0" ver="1.%(n)d" rel="1"/>
+    </rpm:provides>
+    <rpm:requires>
+      <rpm:entry name="libc.so.6()(64bit)"/>
+      <rpm:entry name="pkg%(dep)d"/>
+    </rpm:requires>
+    <file>/usr/bin/pkg%(n)d</file>
+  </format>
+</package>
+"""
+
+def writePrimary(path, count):
+    f = gzip.open(path, 'wb')
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+            'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%d">\n' % count)
+    for n in range(count):
+        f.write(PACKAGE % {'n': n, 'sum': ('%064x' % n), 'size': 1000 + n,
+                           'installed': 4000 + n, 'dep': n / 2})
+    f.write('</metadata>\n')
+    f.close()
+
+def minidomPackages(stream):
+    dom = parse(stream)
+    names = dom.getElementsByTagName("location")
+    sizes = dom.getElementsByTagName("size")
+    checksums = [c for c in dom.getElementsByTagName("checksum")
+                 if c.getAttribute("type") == "sha256"]
+    return [(n.getAttribute("href"), s.getAttribute("package"), c.childNodes[0].data)
+            for n, s, c in zip(names, sizes, checksums)]
+
+def iterparsePackages(stream):
+    return list(repository.iterPrimaryPackages(stream))
+
+def measure(parser, path):
+    """ Run parser over path in a child process, returning the package
+    count, the time taken and the peak RSS in MB. """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        with open(path, 'rb') as f:
+            start = time.time()
+            stream = cpiofile._Stream("", "r", "gz", f, 20*512)
+            count = len(parser(stream))
+            elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        os.write(w, "%d %f %f" % (count, elapsed, peak))
+        os._exit(0)
+    os.close(w)
+    result = os.read(r, 100)
+    os.close(r)
+    os.waitpid(pid, 0)
+    count, elapsed, peak = result.split()
+    return int(count), float(elapsed), float(peak)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--packages', type='int', default=20000)
+    opts, _ = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(prefix='primary-', suffix='.xml.gz')
+    os.close(fd)
+    try:
+        writePrimary(path, opts.packages)
+        print "%d packages, %d KB compressed" % (opts.packages, os.path.getsize(path) / 1024)
+        for name, fn in [('minidom', minidomPackages), ('iterparse', iterparsePackages)]:
+            count, elapsed, peak = measure(fn, path)
+            print "%-10s %6d packages  %6.2fs  peak RSS %6.1f MB" % (name, count, elapsed, peak)
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -125,6 +125,9 @@ MIN_PASSWD_LEN=6
 # file locations - installer filesystem
 EULA_PATH = "/opt/xensource/installer/EULA"
 INSTALLER_DIR="/opt/xensource/installer"
+YUM_PLUGINS_DIR = INSTALLER_DIR + "/yum-plugins"
+# runs yum transactions, reporting the bytes installed of each package
+YUM_TRANSACTION_SCRIPT = INSTALLER_DIR + "/yumtransaction.py"
 timezone_data_file = '/opt/xensource/installer/timezones'
 kbd_data_file = '/opt/xensource/installer/keymaps'
 ANSWERFILE_PATH = '/tmp/answerfile'
@@ -132,6 +135,13 @@ ANSWERFILE_GENERATOR_PATH = '/tmp/answerfile_generator'
 SCRIPTS_DIR = "/tmp/scripts"
 EXTRA_SCRIPTS_DIR = "/tmp/extra-scripts"
 defaults_data_file = '/opt/xensource/installer/defaults.json'
+VERIFICATION_CACHE_FILE = '/tmp/verification-cache.json'
+# packages from remote repositories kept after verification (sizes in MB)
+PAYLOAD_CACHE_DIR = '/tmp/payload-cache'
+PAYLOAD_CACHE_SIZE = 2048
+PAYLOAD_CACHE_RESERVE = 512
+# block size for checksumming packages on local filesystems
+HASH_BLOCK_SIZE = 1048576
 SYSFS_IBFT_DIR = "/sys/firmware/ibft"
 
 # host filesystem - always absolute paths from root of install
@@ -158,6 +168,12 @@ CLUSTERD_CONF = 'var/opt/xapi-clusterd/db'
 
 POST_INSTALL_SCRIPTS_DIR = "etc/xensource/scripts/install"
 
+# packages of remote repositories are copied here before yum installs them
+STAGING_DIR = "var/cache/installer-staging"
+
+# relative to the root of the logs partition
+CHECKPOINT_FILE = "install-checkpoint.json"
+
 SYSLINUX_CFG = "syslinux.cfg"
 ROLLING_POOL_DIR = "boot/installer"
 
@@ -170,6 +186,27 @@ AUTO_EXIT_TIMER = 10 * 1000
 # bootloader timeout
 BOOT_MENU_TIMEOUT = 50
 
+# maximum number of install tasks run concurrently
+MAX_PARALLEL_TASKS = 4
+
+# keep-alive connections to each HTTP repository server
+HTTP_POOL_MAX_CONNECTIONS = 8
+HTTP_POOL_IDLE_TIMEOUT = 30 # seconds
+
+# maximum number of devices probed for installation media at once
+MEDIA_PROBE_WORKERS = 8
+
+# seconds a failed repository mirror is passed over before being retried
+MIRROR_RETRY_INTERVAL = 60
+
+# sharing of packages between installers (TCP for packages, UDP for
+# announcements)
+PEER_CACHE_PORT = 8099
+PEER_CACHE_ANNOUNCE_INTERVAL = 10 # seconds
+PEER_CACHE_TIMEOUT = 10 # seconds
+PEER_CACHE_MAX_TRIES = 3 # peers asked for each package
+PEER_CACHE_MAX_FAILURES = 5
+
 # timeout used for multipath iscsi
 MPATH_ISCSI_TIMEOUT = 15
 
@@ -179,6 +216,11 @@ ISCSI_NODES = 'var/lib/iscsi/nodes'
 CC_PREPARATIONS = False
 CC_FIREWALL_CONF = '/opt/xensource/installer/common_criteria_firewall_rules'
 
+# install packages without syncing each write or installing documentation
+# and locales other than en_US; the target is synced once before unmounting
+RELAXED_DURABILITY = False
+EATMYDATA_LIB = '/usr/lib64/libeatmydata.so'
+
 # list of dom0 services that will be disabled for common criteria preparation,
 # and these can be overridden by answer file
 SERVICES = ["sshd"]
@@ -216,6 +216,42 @@ class _LowLevelFile:
     def write(self, s):
         os.write(self.fd, s)
 
+class _Buffer:
+    """Byte buffer which data is appended to at one end and taken
+       from at the other.  Data is read from the head string at an
+       offset rather than by slicing off what was taken, and strings
+       appended are only joined onto the rest of the head when a
+       read spans them, so each byte is copied a bounded number of
+       times whatever the sizes of the reads.
+    """
+
+    def __init__(self):
+        self.head = ""
+        self.pos = 0
+        self.tail = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, s):
+        if s:
+            self.tail.append(s)
+            self.length += len(s)
+
+    def take(self, size):
+        """Remove and return up to size bytes.
+        """
+        if self.pos + size > len(self.head) and self.tail:
+            self.tail.insert(0, self.head[self.pos:])
+            self.head = "".join(self.tail)
+            self.pos = 0
+            self.tail = []
+        s = self.head[self.pos:self.pos + size]
+        self.pos += len(s)
+        self.length -= len(s)
+        return s
+
 class _Stream:
     """Class that serves as an adapter between CpioFile and
        a stream-like object.  The stream-like object only
@@ -246,7 +282,7 @@ class _Stream:
         self.comptype = comptype
         self.fileobj  = fileobj
         self.bufsize  = bufsize
-        self.buf      = ""
+        self.buf      = _Buffer()
         self.pos      = 0L
         self.closed   = False
 
@@ -268,7 +304,7 @@ class _Stream:
             except ImportError:
                 raise CompressionError("bz2 module is not available")
             if mode == "r":
-                self.dbuf = ""
+                self.dbuf = _Buffer()
                 self.cmp = bz2.BZ2Decompressor()
             else:
                 self.cmp = bz2.BZ2Compressor()
@@ -304,10 +340,9 @@ class _Stream:
         """Write string s to the stream if a whole new block
            is ready to be written.
         """
-        self.buf += s
+        self.buf.append(s)
         while len(self.buf) > self.bufsize:
-            self.fileobj.write(self.buf[:self.bufsize])
-            self.buf = self.buf[self.bufsize:]
+            self.fileobj.write(self.buf.take(self.bufsize))
 
     def close(self):
         """Close the _Stream object. No operation should be
@@ -317,11 +352,10 @@ class _Stream:
             return
 
         if self.mode == "w" and self.comptype != "cpio":
-            self.buf += self.cmp.flush()
+            self.buf.append(self.cmp.flush())
 
-        if self.mode == "w" and self.buf:
-            self.fileobj.write(self.buf)
-            self.buf = ""
+        if self.mode == "w" and len(self.buf):
+            self.fileobj.write(self.buf.take(len(self.buf)))
             if self.comptype == "gz":
                 # The native zlib crc is an unsigned 32-bit integer, but
                 # the Python wrapper implicitly casts that to a signed C
@@ -341,7 +375,7 @@ class _Stream:
         """Initialize for reading a gzip compressed fileobj.
         """
         self.cmp = self.zlib.decompressobj(-self.zlib.MAX_WBITS)
-        self.dbuf = ""
+        self.dbuf = _Buffer()
 
         # taken from gzip.GzipFile with some alterations
         if self.__read(2) != "\037\213":
@@ -410,34 +444,23 @@ class _Stream:
         if self.comptype == "cpio":
             return self.__read(size)
 
-        c = len(self.dbuf)
-        t = [self.dbuf]
-        while c < size:
+        while self.dbuf.length < size:
             buf = self.__read(self.bufsize)
             if not buf:
                 break
-            buf = self.cmp.decompress(buf)
-            t.append(buf)
-            c += len(buf)
-        t = "".join(t)
-        self.dbuf = t[size:]
-        return t[:size]
+            self.dbuf.append(self.cmp.decompress(buf))
+        return self.dbuf.take(size)
 
     def __read(self, size):
         """Return size bytes from stream. If internal buffer is empty,
            read another block from the stream.
         """
-        c = len(self.buf)
-        t = [self.buf]
-        while c < size:
+        while self.buf.length < size:
             buf = self.fileobj.read(self.bufsize)
             if not buf:
                 break
-            t.append(buf)
-            c += len(buf)
-        t = "".join(t)
-        self.buf = t[size:]
-        return t[:size]
+            self.buf.append(buf)
+        return self.buf.take(size)
 # class _Stream
 
 class _StreamProxy(object):
@@ -485,25 +508,20 @@ class _BZ2Proxy(object):
         if self.mode == "r":
             self.bz2obj = bz2.BZ2Decompressor()
             self.fileobj.seek(0)
-            self.buf = ""
+            self.buf = _Buffer()
         else:
             self.bz2obj = bz2.BZ2Compressor()
 
     def read(self, size):
-        b = [self.buf]
-        x = len(self.buf)
-        while x < size:
+        while self.buf.length < size:
             try:
                 raw = self.fileobj.read(self.blocksize)
                 data = self.bz2obj.decompress(raw)
-                b.append(data)
+                self.buf.append(data)
             except EOFError:
                 break
-            x += len(data)
-        self.buf = "".join(b)
 
-        buf = self.buf[:size]
-        self.buf = self.buf[size:]
+        buf = self.buf.take(size)
         self.pos += len(buf)
         return buf
 
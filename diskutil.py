@@ -212,6 +212,41 @@ def removable(device):
 
     return device in getRemovableDeviceList()
 
+def probeFilesystem(device):
+    """ Return the type of filesystem on device, as recognised from its
+    signature, for the types installation media can be on: iso9660, udf,
+    vfat, ext3 or ext4.  Returns None if there is none of those, or the
+    device cannot be read (e.g. an empty drive). """
+    try:
+        f = open(device, 'rb')
+        try:
+            data = f.read(65536)
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+    # ISO9660 and UDF volume descriptors from sector 16 (of 2048 bytes)
+    descriptors = [data[o + 1:o + 6] for o in range(32768, len(data) - 6, 2048)]
+    if 'CD001' in descriptors:
+        return 'iso9660'
+    if 'NSR02' in descriptors or 'NSR03' in descriptors:
+        return 'udf'
+
+    # ext2/3/4 superblock at 1024, magic 0xEF53 at offset 56
+    if len(data) >= 2048 and data[1080:1082] == '\x53\xef':
+        feature_incompat = ord(data[1120]) | (ord(data[1121]) << 8)
+        if feature_incompat & 0x40: # extents
+            return 'ext4'
+        return 'ext3'
+
+    # FAT boot sector
+    if len(data) >= 512 and data[510:512] == '\x55\xaa' and \
+            (data[54:59] in ('FAT12', 'FAT16') or data[82:87] == 'FAT32'):
+        return 'vfat'
+
+    return None
+
 def getQualifiedDeviceName(disk):
     return "/dev/%s" % disk
 
@@ -21,6 +21,8 @@ import simplejson as json
 import tui.installer
 import tui.installer.screens
 import tui.progress
+import progressbus
+import peercache
 import util
 import answerfile
 import uicontroller
@@ -51,6 +53,7 @@ def main(args):
     logger.log("Starting user interface")
     ui.init_ui()
     status = go(ui, args, None, None)
+    progressbus.closeSinks()
     logger.log("Shutting down user interface")
     ui.end_ui()
     return status
@@ -134,6 +137,25 @@ def go(ui, args, answerfile_address, answerfile_script):
             extra_repo_defs += val
         elif opt == "--onecd":
             suppress_extra_cd_dialog = True
+        elif opt == "--resume":
+            results['resume'] = True
+        elif opt == "--progress-rate":
+            progressbus.max_rate = float(val)
+        elif opt == "--progress-serial":
+            progressbus.addSink(progressbus.SerialSink(val))
+        elif opt == "--progress-log":
+            progressbus.addSink(progressbus.JSONLinesSink(val))
+        elif opt == "--progress-socket":
+            progressbus.addSink(progressbus.SocketSink(val))
+        elif opt == "--peer-cache":
+            peercache.start(repository.payload_cache.open,
+                            int(val) if val else constants.PEER_CACHE_PORT)
+        elif opt == "--peer-cache-peers":
+            for peer in val.split(','):
+                host, _, port = peer.partition(':')
+                peercache.peers.add(host, int(port) if port else constants.PEER_CACHE_PORT)
+        elif opt == "--relaxed-durability":
+            constants.RELAXED_DURABILITY = True
         elif opt == "--cc-preparations":
             constants.CC_PREPARATIONS = True
             results['network-backend'] = constants.NETWORK_BACKEND_BRIDGE
@@ -251,16 +273,12 @@ def go(ui, args, answerfile_address, answerfile_script):
                 backend.prettyLogAnswers(scripts.script_dict)
                 logger.log("Starting actual restore")
                 backup = results['backup-to-restore']
+                pd = progressbus.ProgressBus("Restoring %s" % backup,
+                                             "Restoring data - this may take a while...",
+                                             100, ui)
+                restore.restoreFromBackup(backup, pd.update)
+                pd.finish()
                 if ui:
-                    pd = tui.progress.initProgressDialog("Restoring %s" % backup,
-                                                         "Restoring data - this may take a while...",
-                                                         100)
-                def progress(x):
-                    if ui and pd:
-                        tui.progress.displayProgressDialog(x, pd)
-                restore.restoreFromBackup(backup, progress)
-                if ui:
-                    tui.progress.clearModelessDialog()
                     tui.progress.OKDialog("Restore", "The restore operation completed successfully.")
             else:
                 logger.log("Starting actual installation")
@@ -0,0 +1,155 @@
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Sharing of packages between installers: each installer serves the
+# packages in its payload cache by checksum over HTTP, and finds other
+# installers from a static list or from their UDP announcements.
+
+import BaseHTTPServer
+import SocketServer
+import httplib
+import os
+import random
+import re
+import shutil
+import socket
+import threading
+import time
+
+import constants
+from xcp import logger
+
+ANNOUNCEMENT = 'installer-peer-cache'
+
+class PeerList(object):
+    """ Other installers whose payload caches may be read.  Peers which
+    fail repeatedly, or which serve a package not matching its checksum,
+    are no longer used. """
+
+    def __init__(self):
+        self.enabled = False
+        self.instance = os.urandom(8).encode('hex')
+        self._peers = {}
+        self._lock = threading.Lock()
+
+    def add(self, host, port=constants.PEER_CACHE_PORT):
+        with self._lock:
+            if (host, port) not in self._peers:
+                logger.log("Using peer cache at %s:%d" % (host, port))
+                self._peers[(host, port)] = {'failures': 0, 'bad': False}
+            self.enabled = True
+
+    def candidates(self):
+        """ Return a few usable peers in random order, so that requests
+        are spread across them. """
+        with self._lock:
+            peers = [p for p, state in self._peers.items() if not state['bad'] and
+                     state['failures'] < constants.PEER_CACHE_MAX_FAILURES]
+        random.shuffle(peers)
+        return peers[:constants.PEER_CACHE_MAX_TRIES]
+
+    def failed(self, peer, bad=False):
+        with self._lock:
+            state = self._peers[peer]
+            state['failures'] += 1
+            state['bad'] = state['bad'] or bad
+            usable = not state['bad'] and state['failures'] < constants.PEER_CACHE_MAX_FAILURES
+        if not usable:
+            logger.log("Not using peer cache at %s:%d any more" % peer)
+
+    def open(self, peer, sha256sum):
+        """ Return a response reading the package from peer, or None if the
+        peer does not have it. """
+        conn = httplib.HTTPConnection(peer[0], peer[1], timeout=constants.PEER_CACHE_TIMEOUT)
+        try:
+            conn.request('GET', '/' + sha256sum)
+            response = conn.getresponse()
+        except:
+            conn.close()
+            raise
+        if response.status != httplib.OK:
+            response.read()
+            conn.close()
+            if response.status == httplib.NOT_FOUND:
+                return None
+            raise IOError("Peer cache returned %d %s" % (response.status, response.reason))
+        return response
+
+peers = PeerList()
+
+class PeerCacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        name = self.path.lstrip('/')
+        f = None
+        if re.match(r'[0-9a-f]{64}$', name):
+            f = self.server.open_package(name)
+        if not f:
+            self.send_error(httplib.NOT_FOUND)
+            return
+        with f:
+            self.send_response(httplib.OK)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 1048576)
+
+    def log_message(self, format, *args):
+        pass
+
+class PeerCacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves the packages returned by open_package(sha256sum), which gives a
+    package opened for reading or None. """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, open_package, port):
+        BaseHTTPServer.HTTPServer.__init__(self, ('', port), PeerCacheHandler)
+        self.open_package = open_package
+
+def _announce(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    message = "%s %s %d" % (ANNOUNCEMENT, peers.instance, port)
+    while True:
+        try:
+            sock.sendto(message, ('<broadcast>', constants.PEER_CACHE_PORT))
+        except socket.error as e:
+            logger.log("Peer cache announcement failed: %s" % e)
+        time.sleep(constants.PEER_CACHE_ANNOUNCE_INTERVAL)
+
+def _listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # several installers may share the address, e.g. in testing
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', constants.PEER_CACHE_PORT))
+    while True:
+        data, (host, _) = sock.recvfrom(256)
+        fields = data.split()
+        if len(fields) != 3 or fields[0] != ANNOUNCEMENT or fields[1] == peers.instance:
+            continue
+        try:
+            peers.add(host, int(fields[2]))
+        except ValueError:
+            continue
+
+def _daemon(target, *args):
+    t = threading.Thread(target=target, args=args)
+    t.daemon = True
+    t.start()
+
+def start(open_package, port=constants.PEER_CACHE_PORT, announce=True):
+    """ Serve the packages returned by open_package on port and, if announce is
+    set, find other installers and make this one known to them. """
+    server = PeerCacheServer(open_package, port)
+    _daemon(server.serve_forever)
+    logger.log("Serving peer cache on port %d" % port)
+    peers.enabled = True
+    if announce:
+        _daemon(_listen)
+        _daemon(_announce, port)
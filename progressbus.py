@@ -0,0 +1,242 @@
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Progress reporting: updates are coalesced and passed on to a set of sinks
+# (the user interface, a serial line, a log file, a local socket).
+
+import errno
+import os
+import socket
+import threading
+import time
+import simplejson as json
+
+from xcp import logger
+
+# Maximum number of updates per second passed on to the sinks.  Changes of
+# the text are always passed on.
+max_rate = 4
+
+# Sinks which receive all progress in addition to the user interface.
+extra_sinks = []
+
+def addSink(sink):
+    extra_sinks.append(sink)
+
+def closeSinks():
+    for sink in extra_sinks:
+        sink.close()
+
+class ProgressSink(object):
+    """ Receives coalesced progress of one operation at a time. """
+
+    def start(self, title, text, total):
+        pass
+
+    def update(self, current, total, text):
+        pass
+
+    def finish(self):
+        pass
+
+    def close(self):
+        """ Release the resources held by the sink, once the installer is
+        done with it. """
+        pass
+
+class UISink(ProgressSink):
+    """ Displays progress in a progress dialog of the user interface. """
+
+    def __init__(self, ui):
+        self.ui = ui
+        self.pd = None
+
+    def start(self, title, text, total):
+        self.pd = self.ui.progress.initProgressDialog(title, text, total)
+
+    def update(self, current, total, text):
+        self.ui.progress.displayProgressDialog(current, self.pd, updated_text=text)
+
+    def finish(self):
+        self.ui.progress.clearModelessDialog()
+
+class SerialSink(ProgressSink):
+    """ Writes one short line per update to a serial (or other) device. """
+
+    def __init__(self, device):
+        self.device = device
+        self.title = None
+
+    def _write(self, line):
+        with open(self.device, 'a') as f:
+            f.write(line + "\r\n")
+
+    def start(self, title, text, total):
+        self.title = title
+        self._write("== %s" % title)
+
+    def update(self, current, total, text):
+        self._write("%3d%% %s" % (percentage(current, total), text))
+
+    def finish(self):
+        self._write("== %s: done" % self.title)
+
+class JSONLinesSink(ProgressSink):
+    """ Appends a JSON object per update to a file. """
+
+    def __init__(self, path):
+        self.path = path
+        self.title = None
+
+    def _write(self, event, **record):
+        record.update({'time': time.time(), 'event': event, 'title': self.title})
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def start(self, title, text, total):
+        self.title = title
+        self._write('start', text=text, total=total)
+
+    def update(self, current, total, text):
+        self._write('update', text=text, current=current, total=total,
+                    percent=percentage(current, total))
+
+    def finish(self):
+        self._write('finish')
+
+class SocketSink(ProgressSink):
+    """ Listens on a local (Unix domain) socket and sends the latest
+    progress as a JSON object to each client that connects. """
+
+    def __init__(self, path):
+        self.path = path
+        self.status = {'title': None, 'text': None, 'current': 0, 'total': 0,
+                       'percent': 0, 'active': False}
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.closed = False
+        t = threading.Thread(target=self._serve)
+        t.daemon = True
+        t.start()
+
+    def _serve(self):
+        while not self.closed:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error as e:
+                if self.closed:
+                    break
+                if e.errno != errno.EINTR:
+                    logger.log("Progress socket %s: %s" % (self.path, e))
+                    time.sleep(1)
+                continue
+            try:
+                conn.sendall(json.dumps(self.status) + "\n")
+            except socket.error:
+                pass
+            conn.close()
+
+    def start(self, title, text, total):
+        self.status = {'title': title, 'text': text, 'current': 0, 'total': total,
+                       'percent': 0, 'active': True}
+
+    def update(self, current, total, text):
+        status = dict(self.status)
+        status.update({'text': text, 'current': current, 'total': total,
+                       'percent': percentage(current, total)})
+        self.status = status
+
+    def finish(self):
+        status = dict(self.status)
+        status['active'] = False
+        self.status = status
+
+    def close(self):
+        self.closed = True
+        # shutting down wakes up the thread blocked in accept()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def percentage(current, total):
+    if total <= 0:
+        return 0
+    return min(100, int((current * 100) / total))
+
+class ProgressBus(object):
+    """ Progress of one operation.  Updates are passed on to the sinks at
+    most max_rate times per second, and only if the percentage or the text
+    changed; the last of a burst of updates is passed on once the rate
+    allows. """
+
+    def __init__(self, title, text, total, ui=None):
+        self.sinks = list(extra_sinks)
+        if ui:
+            self.sinks.insert(0, UISink(ui))
+        self.total = total
+        self.current = 0
+        self.text = text
+        self.lock = threading.Lock()
+        self.last_update = 0
+        self.last_shown = (0, text)
+        self.timer = None
+        self.finished = False
+        self._dispatch('start', title, text, total)
+
+    def _dispatch(self, method, *args):
+        for sink in self.sinks:
+            try:
+                getattr(sink, method)(*args)
+            except Exception as e:
+                logger.log("Progress sink %s failed: %s" % (sink.__class__.__name__, e))
+
+    def _flush(self, force):
+        shown = (percentage(self.current, self.total), self.text)
+        if shown == self.last_shown:
+            return
+        now = time.time()
+        delay = self.last_update + 1.0 / max_rate - now
+        if not force and delay > 0:
+            if not self.timer:
+                self.timer = threading.Timer(delay, self._deferredFlush)
+                self.timer.daemon = True
+                self.timer.start()
+            return
+        self.last_update = now
+        self.last_shown = shown
+        self._dispatch('update', self.current, self.total, self.text)
+
+    def _deferredFlush(self):
+        with self.lock:
+            self.timer = None
+            if not self.finished:
+                self._flush(True)
+
+    def update(self, current, text=None):
+        with self.lock:
+            self.current = current
+            text_changed = text is not None and text != self.text
+            if text_changed:
+                self.text = text
+            self._flush(text_changed)
+
+    def finish(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self.finished = True
+            self._flush(True)
+            self._dispatch('finish')
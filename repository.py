@@ -12,20 +12,34 @@
 
 import os
 import os.path
+import sys
 import glob
 import errno
 import md5
 import hashlib
+import io
 import tempfile
 import urlparse
 import urllib
 import urllib2
+import httplib
+import socket
+import base64
 import ftplib
 import subprocess
 import re
 import gzip
 import shutil
-from xml.dom.minidom import parse
+import threading
+import time
+import collections
+import multiprocessing
+import simplejson as json
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+import xml.etree.cElementTree as ElementTree
 
 import diskutil
 import hardware
@@ -35,6 +49,8 @@ from util import dev_null
 from xcp.version import *
 from xcp import logger
 import cpiofile
+import peercache
+import constants
 from constants import *
 import xml.dom.minidom
 import ConfigParser
@@ -47,6 +63,26 @@ def getText(nodelist):
             rc = rc + node.data
     return rc.encode().strip()
 
+PRIMARY_NS = '{http://linux.duke.edu/metadata/common}'
+
+def iterPrimaryPackages(fileobj):
+    """ Parse primary.xml from fileobj incrementally, yielding the location,
+    size and sha256 checksum (or None) of each package in turn. """
+    context = ElementTree.iterparse(fileobj, events=('start', 'end'))
+    _, root = context.next()
+    for event, elem in context:
+        if event != 'end' or elem.tag != PRIMARY_NS + 'package':
+            continue
+        checksum = None
+        for node in elem.findall(PRIMARY_NS + 'checksum'):
+            if node.get('type') == 'sha256':
+                checksum = node.text.strip()
+        yield (elem.find(PRIMARY_NS + 'location').get('href'),
+               elem.find(PRIMARY_NS + 'size').get('package'),
+               checksum)
+        # drop the package just parsed from the partial tree
+        root.clear()
+
 class NoRepository(Exception):
     pass
 
@@ -69,31 +105,100 @@ class Repository(object):
         return self._accessor
 
     def check(self, progress=lambda x: ()):
-        """ Return a list of problematic packages. """
-        def pkg_progress(start, end):
+        """ Return a list of problematic packages.  Packages are checked
+        concurrently; progress is reported by bytes checked. """
+        total_size = max(sum((p.size for p in self._packages)), 1)
+        checked = {}
+        checked_size = [0]
+        lock = threading.Lock()
+
+        def check_package(p):
             def progress_fn(x):
-                progress(start + ((x * (end - start)) / 100))
-            return progress_fn
+                size = (p.size * x) / 100
+                with lock:
+                    checked_size[0] += size - checked.get(p, 0)
+                    checked[p] = size
+                    progress((checked_size[0] * 100) / total_size)
+            stamp = self._accessor.stat(p.name)
+            if stamp is not None:
+                stamp = [p.sha256sum] + stamp
+            if cache.verified(p.name, stamp):
+                valid = True
+            else:
+                valid = p.check(False, progress_fn)
+                if valid:
+                    with lock:
+                        cache.record(p.name, stamp)
+            progress_fn(100)
+            return valid
 
         self._accessor.start()
-
         try:
-            problems = []
-            total_size = sum((p.size for p in self._packages))
-            total_progress = 0
-            for p in self._packages:
-                start = (total_progress * 100) / total_size
-                end = ((total_progress + p.size) * 100) / total_size
-                if not p.check(False, pkg_progress(start, end)):
-                    problems.append(p)
-                total_progress += p.size
+            cache = VerificationCache(self)
+            results = util.parallelMap(check_package, self._packages,
+                                       self._accessor.maxConcurrentReads())
+            cache.save()
         finally:
             self._accessor.finish()
-        return problems
+        return [p for p, (valid, _) in zip(self._packages, results) if not valid]
 
     def __iter__(self):
         return self._packages.__iter__()
 
+    def verificationKey(self):
+        """ Return a string identifying the repository contents, or None
+        if they cannot be identified. """
+        return None
+
+class VerificationCache(object):
+    """ Packages of a repository found to be valid by earlier checks,
+    keyed by repository contents and stamped with the checksum, size and
+    modification time (or ETag) of each package.  Kept in the ramdisk and,
+    if writable, on the media itself so other hosts can use it. """
+
+    MEDIA_FILENAME = '.verification-cache.json'
+
+    def __init__(self, repo):
+        self.key = repo.verificationKey()
+        self.paths = []
+        self.entries = {}
+        if self.key is None:
+            return
+
+        self.paths.append(VERIFICATION_CACHE_FILE)
+        location = getattr(repo.accessor(), 'location', None)
+        if location and os.access(location, os.W_OK):
+            self.paths.append(os.path.join(location, self.MEDIA_FILENAME))
+        for path in self.paths:
+            self.entries.update(self._load(path).get(self.key, {}))
+        logger.log("Verification cache has %d entries for %s" % (len(self.entries), self.key))
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def verified(self, name, stamp):
+        return stamp is not None and self.entries.get(name) == stamp
+
+    def record(self, name, stamp):
+        if stamp is not None:
+            self.entries[name] = stamp
+
+    def save(self):
+        for path in self.paths:
+            data = self._load(path)
+            data[self.key] = self.entries
+            try:
+                with open(path + '.new', 'w') as f:
+                    json.dump(data, f)
+                os.rename(path + '.new', path)
+            except (IOError, OSError) as e:
+                logger.log("Failed to write verification cache %s: %s" % (path, e))
+
 def _generateYumConf(cachedir):
     return """[main]
 cachedir=/%s
@@ -103,12 +208,14 @@ logfile=/var/log/yum.log
 exactarch=1
 obsoletes=1
 gpgcheck=0
-plugins=0
+plugins=1
+pluginpath=%s
+pluginconfpath=%s
 installonlypkgs=
 distroverpkg=xenserver-release
 reposdir=/tmp/repos
 history_record=false
-""" % cachedir
+""" % (cachedir, YUM_PLUGINS_DIR, YUM_PLUGINS_DIR)
 
 _yumRepositoryId = 1
 class YumRepository(Repository):
@@ -116,6 +223,10 @@ class YumRepository(Repository):
     REPOMD_FILENAME = "repodata/repomd.xml"
     _cachedir = "var/cache/yum/installer"
     _targets = None
+    _rootfs_image = None
+    _build_number = None
+    _repomd_checksum = None
+    _repodata = []
 
     def __init__(self, accessor):
         super(YumRepository, self).__init__(accessor)
@@ -131,41 +242,88 @@ class YumRepository(Repository):
         return None
 
     def _parse_repodata(self, accessor):
-        # Read packages from xml
         repomdfp = accessor.openAddress(self.REPOMD_FILENAME)
-        repomd_xml = parse(repomdfp)
+        repomd_data = repomdfp.read()
+        self._repomd_checksum = hashlib.sha256(repomd_data).hexdigest()
+        repomd_xml = xml.dom.minidom.parseString(repomd_data)
         xml_datas = repomd_xml.getElementsByTagName("data")
+        locations = {}
         for data_node in xml_datas:
             data = data_node.getAttribute("type")
-            if data == "primary":
-                primary_location = data_node.getElementsByTagName("location")
-                primary_location = primary_location[0].getAttribute("href")
+            location = data_node.getElementsByTagName("location")
+            locations[data] = location[0].getAttribute("href")
         repomdfp.close()
 
-        primaryfp = accessor.openAddress(primary_location)
+        self._repodata = [self.REPOMD_FILENAME] + locations.values()
+
+        # Prefer the sqlite database, which needs no XML parsing
+        self._packages = None
+        if 'primary_db' in locations and sqlite3:
+            try:
+                self._packages = self._read_primary_db(accessor, locations['primary_db'])
+            except Exception as e:
+                logger.log("Failed to read %s, using primary XML instead: %s" % (locations['primary_db'], str(e)))
+        if self._packages is None:
+            self._packages = self._read_primary_xml(accessor, locations['primary'])
+
+    def _read_primary_xml(self, accessor, location):
+        primaryfp = accessor.openAddress(location)
         # Open compressed xml using cpiofile._Stream which is an adapter between CpioFile and a stream-like object.
         # Useful when specifying the URL for HTTP or FTP repository - A simple GzipFile object will not work in this situation.
         primary_xml = cpiofile._Stream("", "r", "gz", primaryfp, 20*512)
-        primary_dom = parse(primary_xml)
-        package_names = primary_dom.getElementsByTagName("location")
-        package_sizes = primary_dom.getElementsByTagName("size")
-        package_checksums = primary_dom.getElementsByTagName("checksum")
-        primary_xml.close()
-        primaryfp.close()
-
-        # Filter using only sha256 checksum
-        sha256_checksums = filter(lambda x: x.getAttribute("type") == "sha256", package_checksums)
-
-        # After the filter, the list of checksums will have the same size
-        # of the list of names
-        self._packages = []
-        for name_node, size_node, checksum_node in zip(package_names, package_sizes, sha256_checksums):
-            name = name_node.getAttribute("href")
-            size = size_node.getAttribute("package")
-            checksum = checksum_node.childNodes[0]
-            pkg = RPMPackage(self, name, size, checksum.data)
-            pkg.type = 'rpm'
-            self._packages.append(pkg)
+        packages = []
+        try:
+            for name, size, checksum in iterPrimaryPackages(primary_xml):
+                if checksum is None:
+                    logger.log("Ignoring package %s without sha256 checksum" % name)
+                    continue
+                pkg = RPMPackage(self, name, size, checksum)
+                pkg.type = 'rpm'
+                packages.append(pkg)
+        finally:
+            primary_xml.close()
+            primaryfp.close()
+        return packages
+
+    def _read_primary_db(self, accessor, location):
+        comptypes = {'.sqlite': None, '.bz2': 'bz2', '.gz': 'gz'}
+        ext = os.path.splitext(location)[1]
+        if ext not in comptypes:
+            raise RepoFormatError("Unsupported compression of %s" % location)
+
+        # sqlite needs a file, so decompress the database into the ramdisk
+        fd, db_path = tempfile.mkstemp(prefix="primary-", suffix=".sqlite", dir="/tmp")
+        try:
+            # the descriptor is closed with out, whether or not the
+            # database can be opened
+            with os.fdopen(fd, 'wb') as out:
+                dbfp = accessor.openAddress(location)
+                try:
+                    if comptypes[ext]:
+                        stream = cpiofile._Stream("", "r", comptypes[ext], dbfp, 20*512)
+                    else:
+                        stream = dbfp
+                    shutil.copyfileobj(stream, out, 1048576)
+                finally:
+                    dbfp.close()
+
+            conn = sqlite3.connect(db_path)
+            try:
+                rows = conn.execute("SELECT location_href, size_package, checksum_type, pkgId "
+                                    "FROM packages ORDER BY pkgKey")
+                packages = []
+                for name, size, checksum_type, checksum in rows:
+                    if checksum_type != 'sha256':
+                        logger.log("Ignoring package %s without sha256 checksum" % name)
+                        continue
+                    pkg = RPMPackage(self, str(name), size, str(checksum))
+                    pkg.type = 'rpm'
+                    packages.append(pkg)
+            finally:
+                conn.close()
+        finally:
+            os.unlink(db_path)
+        return packages
 
     def __repr__(self):
         return "%s@yum" % self._identifier
@@ -181,6 +339,11 @@ class YumRepository(Repository):
     def name(self):
         return self._identifier
 
+    def verificationKey(self):
+        if self._repomd_checksum is None:
+            return None
+        return "%s:%s:%s" % (self._identifier, self._build_number, self._repomd_checksum)
+
     def __eq__(self, other):
         return self.identifier() == other.identifier()
 
@@ -193,27 +356,10 @@ class YumRepository(Repository):
 
     def _installPackages(self, progress_callback, mounts):
         assert self._targets is not None
-        url = self._accessor.url()
-        logger.log("URL: " + str(url))
-        with open('/root/yum.conf', 'w') as yum_conf:
-            yum_conf.write(self._yum_conf)
-            yum_conf.write("""
-[install]
-name=install
-baseurl=%s
-""" % url.getPlainURL())
-            username = url.getUsername()
-            if username is not None:
-                yum_conf.write("username=%s\n" % (url.getUsername(),))
-            password = url.getPassword()
-            if password is not None:
-                yum_conf.write("password=%s\n" % (url.getPassword(),))
-            repo_config = self._repo_config()
-            if repo_config is not None:
-                yum_conf.write(repo_config)
-
+        logger.log("URL: " + str(self._accessor.url()))
         self.disableInitrdCreation(mounts['root'])
-        installFromYum(self._targets, mounts, progress_callback, self._cachedir)
+        installFromYumRepos([self], self._targets, mounts, progress_callback,
+                            self._cachedir, self._yum_conf)
         self.enableInitrdCreation()
 
     def installPackages(self, progress_callback, mounts):
@@ -229,6 +375,9 @@ baseurl=%s
     def enableInitrdCreation(self):
         pass
 
+    def hasRootfsImage(self):
+        return self._rootfs_image is not None
+
     def getBranding(self, mounts, branding):
         return branding
 
@@ -248,6 +397,22 @@ class MainYumRepository(YumRepositoryWithInfo):
     INFO_FILENAME = ".treeinfo"
     _targets = ['@xenserver_base', '@xenserver_dom0']
 
+    # A prebuilt root filesystem image may be listed in .treeinfo:
+    #   [rootfs-image]
+    #   location = images/rootfs.tar.xz
+    #   format = tar.xz
+    #   size = <bytes, optional, for progress>
+    #   sha256 = <optional>
+    # Below are the tar options for each supported format, None for images
+    # which are unpacked with unsquashfs.
+    ROOTFS_IMAGE_FORMATS = {
+        'tar': [],
+        'tar.gz': ['-z'],
+        'tar.bz2': ['-j'],
+        'tar.xz': ['-J'],
+        'squashfs': None,
+        }
+
     def __init__(self, accessor):
         super(MainYumRepository, self).__init__(accessor)
         self._identifier = MAIN_REPOSITORY_NAME
@@ -302,6 +467,12 @@ class MainYumRepository(YumRepositoryWithInfo):
             if treeinfo.has_section('keys'):
                 for _, keyfile in treeinfo.items('keys'):
                     self.keyfiles.append(keyfile)
+            if treeinfo.has_section('rootfs-image'):
+                self._rootfs_image = dict(treeinfo.items('rootfs-image'))
+                if self._rootfs_image.get('format') not in self.ROOTFS_IMAGE_FORMATS:
+                    logger.log("Ignoring root filesystem image %s of unknown format %s" %
+                               (self._rootfs_image.get('location'), self._rootfs_image.get('format')))
+                    self._rootfs_image = None
         except Exception as e:
             accessor.finish()
             logger.logException(e)
@@ -341,7 +512,8 @@ gpgkey=file://%s
         # It is created after the yum install phase.
         confdir = os.path.join(root, 'etc', 'dracut.conf.d')
         self._conffile = os.path.join(confdir, 'xs_disable.conf')
-        os.makedirs(confdir, 0775)
+        if not os.path.isdir(confdir):
+            os.makedirs(confdir, 0775)
         with open(self._conffile, 'w') as f:
             print >> f, 'echo Skipping initrd creation during host installation'
             print >> f, 'exit 0'
@@ -349,6 +521,77 @@ gpgkey=file://%s
     def enableInitrdCreation(self):
         os.unlink(self._conffile)
 
+    def installRootfsImage(self, progress_callback, mounts):
+        """ Unpack the prebuilt root filesystem image listed in the
+        rootfs-image section of .treeinfo onto the target, instead of
+        installing the package groups. """
+        location = self._rootfs_image['location']
+        fmt = self._rootfs_image['format']
+        size = long(self._rootfs_image.get('size', 0))
+        logger.log("Unpacking root filesystem image %s (%s)" % (location, fmt))
+
+        # The image is checked before anything is unpacked, so one with a
+        # checksum is copied to the target first, as is a squashfs image,
+        # which unsquashfs needs random access to; others are streamed.
+        sha256 = self._rootfs_image.get('sha256')
+        tar_args = ['tar', '-x', '-p', '--numeric-owner',
+                    '--xattrs', '--xattrs-include=*', '-C', mounts['root']]
+        staged = None
+        tar = None
+        out = None
+        imagefp = self._accessor.openAddress(location)
+        try:
+            if sha256 or self.ROOTFS_IMAGE_FORMATS[fmt] is None:
+                staged = os.path.join(mounts['root'], '.rootfs-image')
+                out = open(staged, 'wb')
+            else:
+                tar = subprocess.Popen(tar_args + self.ROOTFS_IMAGE_FORMATS[fmt],
+                                       stdin=subprocess.PIPE)
+                out = tar.stdin
+
+            m = hashlib.sha256()
+            total_read = 0
+            while True:
+                data = imagefp.read(1048576)
+                if data == '':
+                    break
+                m.update(data)
+                try:
+                    out.write(data)
+                except IOError as e:
+                    # tar has exited, and its status says why
+                    if not tar or e.errno != errno.EPIPE:
+                        raise
+                    break
+                total_read += len(data)
+                if size > 0:
+                    progress_callback(min(total_read * 100 / size, 100))
+            out.close()
+
+            if tar:
+                rv = tar.wait()
+            elif sha256 and m.hexdigest() != sha256:
+                raise ErrorInstallingPackage("Checksum mismatch for root filesystem image %s" % location)
+            elif self.ROOTFS_IMAGE_FORMATS[fmt] is None:
+                rv = util.runCmd2(['unsquashfs', '-f', '-d', mounts['root'], staged])
+            else:
+                rv = util.runCmd2(tar_args + self.ROOTFS_IMAGE_FORMATS[fmt] + ['-f', staged])
+        finally:
+            imagefp.close()
+            if out and not out.closed:
+                try:
+                    out.close()
+                except IOError:
+                    pass
+            if tar and tar.returncode is None:
+                # failed before tar finished: don't leave it behind
+                tar.kill()
+                tar.wait()
+            if staged and os.path.exists(staged):
+                os.unlink(staged)
+        if rv:
+            raise ErrorInstallingPackage("Error unpacking root filesystem image %s: exit status %d" % (location, rv))
+
     def getBranding(self, mounts, branding):
         if self._platform_data:
             branding.update({'platform-name': self._platform_data['name'],
@@ -449,6 +692,8 @@ baseurl=%s
         return False
 
 class RPMPackage(object):
+    __slots__ = ('repository', 'name', 'size', 'sha256sum', 'type')
+
     def __init__(self, repository, name, size, sha256sum):
         self.repository = repository
         self.name = name
@@ -463,25 +708,173 @@ class RPMPackage(object):
         else:
             try:
                 logger.log("Validating package %s" % self.name)
-                namefp = self.repository.accessor().openAddress(self.name)
-                m = hashlib.sha256()
-                data = ''
-                total_read = 0
-                while True:
-                    data = namefp.read(10485760)
-                    total_read += len(data)
-                    if data == '':
-                        break
-                    else:
-                        m.update(data)
-                    progress(total_read / (self.size / 100))
-                namefp.close()
-                calculated = m.hexdigest()
-                valid = (self.sha256sum == calculated)
-                return valid
+                return self.sha256sum == self._read(progress)
             except Exception as e:
                 return False
 
+    def stage(self, path, progress=lambda x : ()):
+        """ Copy the package to path, checking it against its known
+        checksum on the way. """
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as out:
+            calculated = self._read(progress, out)
+        if calculated != self.sha256sum:
+            raise ErrorInstallingPackage("Checksum mismatch for package %s" % self.name)
+
+    def _read(self, progress, out=None):
+        """ Read the package, copying it to out if given, and return its
+        sha256 checksum. """
+        accessor = self.repository.accessor()
+        cache_out = None
+        cached = payload_cache.open(self.sha256sum)
+        if out is None:
+            if cached:
+                return hashFile(cached, self.size, progress)
+            if accessor.isLocal():
+                return hashLocalFile(accessor.localPath(self.name), self.size, progress)
+        if cached:
+            namefp = cached
+        else:
+            namefp = accessor.openPayload(self.name, self.sha256sum, self.size)
+            if not accessor.isLocal():
+                cache_out = payload_cache.reserve(self.sha256sum, self.size)
+        calculated = None
+        try:
+            m = hashlib.sha256()
+            data = ''
+            total_read = 0
+            while True:
+                data = namefp.read(10485760)
+                total_read += len(data)
+                if data == '':
+                    break
+                else:
+                    m.update(data)
+                    if out:
+                        out.write(data)
+                    if cache_out:
+                        cache_out.write(data)
+                progress(min((total_read * 100) / max(self.size, 1), 100))
+            calculated = m.hexdigest()
+        finally:
+            namefp.close()
+            if cache_out:
+                payload_cache.commit(self.sha256sum, cache_out, calculated == self.sha256sum)
+        return calculated
+
+_hash_buffers = threading.local()
+
+def hashLocalFile(path, size, progress=lambda x: ()):
+    """ Return the sha256 checksum of a local file of the given size. """
+    return hashFile(io.open(path, 'rb', buffering=0), size, progress)
+
+def hashFile(f, size, progress=lambda x: ()):
+    """ Return the sha256 checksum of f, a local file of the given size
+    opened unbuffered, and close it.  The file is read into a buffer
+    reused by the thread, and dropped from the page cache as it is read so
+    that the ramdisk is left to the installer. """
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None:
+        buf = _hash_buffers.buf = bytearray(HASH_BLOCK_SIZE)
+    m = hashlib.sha256()
+    total_read = 0
+    with f:
+        util.fadvise(f.fileno(), 0, 0, util.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            m.update(buffer(buf, 0, n))
+            util.fadvise(f.fileno(), total_read, n, util.POSIX_FADV_DONTNEED)
+            total_read += n
+            progress(min((total_read * 100) / max(size, 1), 100))
+    return m.hexdigest()
+
+class PayloadCache(object):
+    """ Packages read from remote repositories, kept by checksum once
+    found valid so that later reads (e.g. installing after verifying)
+    do not fetch them again.  Bounded by max_size bytes, and by keeping
+    keep_free bytes free on the filesystem holding it: the least recently
+    used packages are evicted to make room for new ones. """
+
+    def __init__(self, directory, max_size, keep_free):
+        self.directory = directory
+        self.max_size = max_size
+        self.keep_free = keep_free
+        self.size = 0
+        # checksum -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def _path(self, sha256sum):
+        return os.path.join(self.directory, sha256sum)
+
+    def _free(self):
+        st = os.statvfs(self.directory)
+        return st.f_bavail * st.f_frsize
+
+    def open(self, sha256sum):
+        """ Return the cached package opened unbuffered, or None. """
+        with self.lock:
+            if sha256sum not in self.entries:
+                return None
+            # opened under the lock, so that it cannot be evicted first
+            self.entries[sha256sum] = self.entries.pop(sha256sum)
+            return io.open(self._path(sha256sum), 'rb', buffering=0)
+
+    def _evict(self, size):
+        """ Drop the least recently used packages until size more bytes
+        fit, returning whether they do. """
+        while self.size + size > self.max_size or self._free() - size < self.keep_free:
+            if not self.entries:
+                return False
+            sha256sum, entry_size = self.entries.popitem(last=False)
+            os.unlink(self._path(sha256sum))
+            self.size -= entry_size
+        return True
+
+    def reserve(self, sha256sum, size):
+        """ Return a file to write the package to while it is read, or
+        None if it should not be cached. """
+        with self.lock:
+            if sha256sum in self.entries or sha256sum in self.pending:
+                return None
+            if size > self.max_size:
+                return None
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            if not self._evict(size):
+                return None
+            self.size += size
+            self.pending[sha256sum] = size
+        return open(self._path(sha256sum) + '.part', 'wb')
+
+    def commit(self, sha256sum, out, valid):
+        """ Keep the package written to out if it was found valid. """
+        out.close()
+        path = self._path(sha256sum)
+        with self.lock:
+            size = self.pending.pop(sha256sum)
+            if valid:
+                os.rename(path + '.part', path)
+                self.entries[sha256sum] = size
+            else:
+                os.unlink(path + '.part')
+                self.size -= size
+
+    def clear(self):
+        """ Drop every cached package, once the installation is over. """
+        with self.lock:
+            for sha256sum, size in self.entries.items():
+                os.unlink(self._path(sha256sum))
+                self.size -= size
+            self.entries.clear()
+
+payload_cache = PayloadCache(PAYLOAD_CACHE_DIR, PAYLOAD_CACHE_SIZE * 1024 * 1024,
+                             PAYLOAD_CACHE_RESERVE * 1024 * 1024)
+
 class Accessor:
     def pathjoin(base, name):
         return os.path.join(base, name)
@@ -498,9 +891,32 @@ class Accessor:
         else:
             return True
 
+    def openPayload(self, name, sha256sum, size):
+        """ Open the package 'name', known by its checksum and size. """
+        return self.openAddress(name)
+
+    def localPath(self, name):
+        """ Return the path of 'name' in the local filesystem, or None if it
+        is not directly accessible. """
+        return None
+
     def canEject(self):
         return False
 
+    def isLocal(self):
+        """ Return whether reading from the accessor needs no network. """
+        return True
+
+    def stat(self, name):
+        """ Return a list of attributes which change whenever 'name' is
+        modified, or None if they cannot be determined. """
+        return None
+
+    def maxConcurrentReads(self):
+        """ Return how many files should be read at once, e.g. when
+        checking packages. """
+        return min(multiprocessing.cpu_count(), 8)
+
     def start(self):
         pass
 
@@ -530,6 +946,16 @@ class FilesystemAccessor(Accessor):
     def openAddress(self, addr):
         return open(os.path.join(self.location, addr), 'r')
 
+    def localPath(self, name):
+        return os.path.join(self.location, name)
+
+    def stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.location, name))
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime]
+
     def url(self):
         return util.URL("file://%s" % self.location)
 
@@ -586,25 +1012,236 @@ class DeviceAccessor(MountingAccessor):
     def __repr__(self):
         return "<DeviceAccessor: %s>" % self.device
 
+    def start(self):
+        if self.start_count == 0:
+            # try the filesystem found on the device first
+            fs = diskutil.probeFilesystem(self.device)
+            if fs in self.mount_types:
+                self.mount_types = [fs] + [t for t in self.mount_types if t != fs]
+        MountingAccessor.start(self)
+
     def canEject(self):
         return diskutil.removable(self.device)
 
+    def maxConcurrentReads(self):
+        # optical drives are slowed down considerably by seeking
+        if re.match(r'/dev/(sr|scd)\d+$', self.device):
+            return 1
+        return MountingAccessor.maxConcurrentReads(self)
+
     def eject(self):
         if self.canEject():
-            self.finish()
+            registry.forgetAccessor(self)
+            while self.start_count > 0:
+                self.finish()
             util.runCmd2(['eject', self.device])
 
 class NFSAccessor(MountingAccessor):
     def __init__(self, nfspath):
         MountingAccessor.__init__(self, ['nfs'], nfspath, ['ro', 'tcp'])
 
-class URLFileWrapper:
-    "This wrapper emulate seek (forwards) for URL streams"
-    SEEK_SET = 0 # SEEK_CUR and SEEK_END not supported
+    def isLocal(self):
+        return False
+
+class HTTPConnectionPool(object):
+    """ Keep-alive connections to one HTTP(S) server, shared by all the
+    accessors using that server.  At most max_connections requests are
+    open at once; idle connections are dropped after idle_timeout seconds. """
+
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, scheme, netloc):
+        with cls._pools_lock:
+            if (scheme, netloc) not in cls._pools:
+                cls._pools[(scheme, netloc)] = cls(scheme, netloc)
+            return cls._pools[(scheme, netloc)]
+
+    def __init__(self, scheme, netloc, max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                 idle_timeout=HTTP_POOL_IDLE_TIMEOUT):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc)
+        return httplib.HTTPConnection(self.netloc)
+
+    def _idleConnection(self):
+        with self.lock:
+            while self.idle:
+                last_used, conn = self.idle.pop()
+                if time.time() - last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+        return None
+
+    def release(self, conn, reuse):
+        if reuse:
+            with self.lock:
+                self.idle.append((time.time(), conn))
+        else:
+            conn.close()
+        self.slots.release()
+
+    def open(self, path, headers={}, status=httplib.OK, method='GET'):
+        """ Request path, returning a file-like object for the response, or
+        None if the server did not respond with status (e.g. a redirect or
+        an authentication challenge) and the caller should fall back to
+        urllib2. """
+        self.slots.acquire()
+        conn = self._idleConnection()
+        try:
+            try:
+                if conn is None:
+                    raise httplib.NotConnected()
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # the server may have closed the idle connection: try a new one
+                if conn:
+                    conn.close()
+                conn = self._connect()
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+        except:
+            if conn:
+                conn.close()
+            self.slots.release()
+            raise
+
+        if response.status != status:
+            PooledHTTPResponse(self, conn, response).close()
+            return None
+        return PooledHTTPResponse(self, conn, response)
+
+class PooledHTTPResponse(object):
+    """ File-like response from an HTTPConnectionPool, which hands the
+    connection back to the pool when closed. """
+
+    def __init__(self, pool, conn, response):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self._buffer = ''
+
+    def info(self):
+        return self._response.msg
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + self._response.read()
+            self._buffer = ''
+        elif self._buffer:
+            data = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+        else:
+            data = self._response.read(size)
+        return data
+
+    def readline(self):
+        while '\n' not in self._buffer:
+            data = self._response.read(8192)
+            if not data:
+                break
+            self._buffer += data
+        i = self._buffer.find('\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:i], self._buffer[i:]
+        return line
+
+    def readlines(self):
+        return list(iter(self.readline, ''))
+
+    def close(self):
+        if self._conn:
+            # the connection can only be reused once the response is consumed
+            if self._response.length is not None and self._response.length <= 65536:
+                try:
+                    self._response.read()
+                except (httplib.HTTPException, socket.error):
+                    pass
+            reuse = self._response.isclosed() and not self._response.will_close
+            self._pool.release(self._conn, reuse)
+            self._conn = None
+
+    def __del__(self):
+        self.close()
+
+class FTPDataFile(object):
+    """ File-like object for a transfer on an FTP session of a URLAccessor,
+    which hands the session back to the accessor when closed. """
+
+    def __init__(self, accessor, ftp, conn):
+        self._accessor = accessor
+        self._ftp = ftp
+        self._conn = conn
+        self._file = conn.makefile('rb')
+
+    def info(self):
+        return {}
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self):
+        return self._file.readline()
+
+    def readlines(self):
+        return self._file.readlines()
 
-    def __init__(self, delegate):
+    def close(self):
+        if self._ftp:
+            complete = self._file.read(1) == ''
+            self._file.close()
+            self._conn.close()
+            try:
+                if complete:
+                    self._ftp.voidresp()
+                else:
+                    # abandoned part-way: the session is in an unknown state
+                    raise ftplib.Error("transfer aborted")
+            except ftplib.all_errors:
+                self._accessor._releaseFTP(self._ftp, False)
+            else:
+                self._accessor._releaseFTP(self._ftp)
+            self._ftp = None
+
+    def __del__(self):
+        self.close()
+
+class URLFileWrapper:
+    """This wrapper emulates seek for URL streams.  If the server accepts
+    byte ranges, seeking backwards or far forwards re-requests the file
+    from the new offset; otherwise only forward seeks are possible, by
+    reading and discarding data."""
+    SEEK_SET = 0
+    SEEK_CUR = 1
+    SEEK_END = 2 # only if the length is known
+
+    # forward seeks up to this distance read and discard data
+    DISCARD_LIMIT = 65536
+
+    def __init__(self, delegate, reopen=None):
+        """ reopen, if given, is called with an offset and returns a new
+        delegate, and the offset it reads from: the offset asked for, or 0
+        if the server sent the whole file. """
         self.delegate = delegate
         self.pos = 0
+        self.reopen = None
+        self.length = None
+        info = delegate.info()
+        if info.get('Content-Length', '').isdigit():
+            self.length = long(info.get('Content-Length'))
+        if reopen and info.get('Accept-Ranges', '').lower() == 'bytes':
+            self.reopen = reopen
 
     def __getattr__(self, name):
         return getattr(self.delegate, name)
@@ -614,15 +1251,35 @@ class URLFileWrapper:
         self.pos += len(ret_val)
         return ret_val
 
+    def readline(self, *params):
+        ret_val = self.delegate.readline(*params)
+        self.pos += len(ret_val)
+        return ret_val
+
+    def tell(self):
+        return self.pos
+
     def seek(self, offset, whence=0):
+        if whence == self.SEEK_CUR:
+            offset += self.pos
+        elif whence == self.SEEK_END:
+            if self.length is None:
+                raise Exception('SEEK_END not supported, length unknown')
+            offset += self.length
+        elif whence != self.SEEK_SET:
+            raise Exception('Unknown whence %d' % whence)
+
+        if self.reopen and (offset < self.pos or offset - self.pos > self.DISCARD_LIMIT):
+            # close the current request first: both may need a slot of
+            # the same connection pool
+            self.delegate.close()
+            self.delegate, self.pos = self.reopen(offset)
+
         consume = 0
-        if whence == self.SEEK_SET:
-            if offset >= self.pos:
-                consume = offset - self.pos
-            else:
-                raise Exception('Backward seek not supported')
+        if offset >= self.pos:
+            consume = offset - self.pos
         else:
-            raise Exception('Only SEEK_SET supported')
+            raise Exception('Backward seek not supported')
 
         if consume > 0:
             step = 100000
@@ -652,6 +1309,17 @@ class URLAccessor(Accessor):
                 self.opener = urllib2.build_opener(self.authhandler)
                 urllib2.install_opener(self.opener)
 
+        self._start_count = 0
+        self._ftp_lock = threading.Lock()
+        self._ftp_idle = []
+        self._ftp_listings = {}
+
+        # Requests through a proxy are left to urllib2
+        self._pool = None
+        if self._url.getScheme() in ['http', 'https'] and self._url.getScheme() not in urllib.getproxies():
+            netloc = urlparse.urlsplit(self._url.getPlainURL()).netloc
+            self._pool = HTTPConnectionPool.get(self._url.getScheme(), netloc)
+
         logger.log("Initializing URLRepositoryAccessor with base address %s" % str(self._url))
 
     def _url_concat(url1, end):
@@ -674,61 +1342,574 @@ class URLAccessor(Accessor):
     _url_decode = staticmethod(_url_decode)
 
     def start(self):
-        pass
+        self._start_count += 1
 
     def finish(self):
-        pass
+        if self._start_count > 0:
+            self._start_count -= 1
+        if self._start_count == 0:
+            self._closeFTP()
+
+    def isLocal(self):
+        return self._url.getScheme() == 'file'
+
+    def maxConcurrentReads(self):
+        if self._url.getScheme() == 'ftp':
+            # one control connection, to keep clear of login rate limits
+            return 1
+        # bound by latency rather than by CPU
+        return 8
+
+    def stat(self, name):
+        if self._url.getScheme() not in ['http', 'https']:
+            return None
+        url = self._url_concat(self._url.getPlainURL(), name)
+        try:
+            response = None
+            if self._pool:
+                response = self._pool.open(self._requestPath(url), self._requestHeaders(),
+                                           method='HEAD')
+            if response is None:
+                request = urllib2.Request(url)
+                request.get_method = lambda: 'HEAD'
+                response = urllib2.urlopen(request)
+        except Exception:
+            return None
+        try:
+            headers = response.info()
+            if not headers.get('ETag') and not headers.get('Last-Modified'):
+                return None
+            return [headers.get('Content-Length'), headers.get('ETag'), headers.get('Last-Modified')]
+        finally:
+            response.close()
+
+    def _ftpPath(self, address):
+        """ Return the path of address relative to the FTP login directory. """
+        url = self._url_concat(self._url.getPlainURL(), address)
+        (scheme, netloc, path, params, query) = urlparse.urlsplit(url)
+        return self._url_decode(path[1:])
+
+    def _getFTP(self):
+        """ Return a logged-in FTP session, reusing an idle one if possible. """
+        with self._ftp_lock:
+            if self._ftp_idle:
+                return self._ftp_idle.pop()
+        port = urlparse.urlsplit(self._url.getPlainURL()).port or ftplib.FTP_PORT
+        ftp = ftplib.FTP()
+        ftp.connect(self._url.getHostname(), port)
+        ftp.login(self._url.getUsername() or '', self._url.getPassword() or '')
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def _releaseFTP(self, ftp, reuse=True):
+        if reuse:
+            with self._ftp_lock:
+                self._ftp_idle.append(ftp)
+        else:
+            ftp.close()
+
+    def _closeFTP(self):
+        with self._ftp_lock:
+            sessions, self._ftp_idle = self._ftp_idle, []
+            self._ftp_listings = {}
+        for ftp in sessions:
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+    def _ftpListing(self, directory):
+        """ Return the names in directory, listed once per session. """
+        with self._ftp_lock:
+            if directory in self._ftp_listings:
+                return self._ftp_listings[directory]
+        ftp = self._getFTP()
+        try:
+            try:
+                names = set(os.path.basename(n) for n in ftp.nlst(directory or '.'))
+            except ftplib.error_perm:
+                # missing (or, on some servers, empty) directory
+                names = set()
+        except:
+            self._releaseFTP(ftp, False)
+            raise
+        self._releaseFTP(ftp)
+        with self._ftp_lock:
+            self._ftp_listings[directory] = names
+        return names
 
     def access(self, path):
-        if not self._url.getScheme == 'ftp':
+        if self._url.getScheme() != 'ftp':
             return Accessor.access(self, path)
 
-        url = self._url_concat(self._url.getPlainURL(), path)
-
         # if FTP, override by actually checking the file exists because urllib2 seems
         # to be not so good at this.
         try:
-            (scheme, netloc, path, params, query) = urlparse.urlsplit(url)
-            fname = os.path.basename(path)
-            directory = self._url_decode(os.path.dirname(path[1:]))
-            hostname = self._url.getHostname()
-            username = self._url.getUsername()
-            password = self._url.getPassword()
-
-            # now open a connection to the server and verify that fname is in
-            ftp = ftplib.FTP(hostname)
-            ftp.login(username, password)
-            ftp.cwd(directory)
-            if ftp.size(fname) is not None:
-                return True
-            lst = ftp.nlst()
-            return fname in lst
-        except:
-            # couldn't parse the server name out:
+            path = self._ftpPath(path)
+            return os.path.basename(path) in self._ftpListing(os.path.dirname(path))
+        except Exception as e:
+            logger.log("FTP listing for %s failed: %s" % (path, str(e)))
             return False
 
     def openAddress(self, address):
+        if self._url.getScheme() == 'ftp':
+            ftp = self._getFTP()
+            try:
+                conn = ftp.transfercmd('RETR ' + self._ftpPath(address))
+            except ftplib.error_perm as e:
+                self._releaseFTP(ftp)
+                raise IOError(str(e))
+            except:
+                self._releaseFTP(ftp, False)
+                raise
+            return URLFileWrapper(FTPDataFile(self, ftp, conn))
         if self._url.getScheme() in ['http', 'https']:
-            ret_val = urllib2.urlopen(self._url_concat(self._url.getPlainURL(), address))
+            url = self._url_concat(self._url.getPlainURL(), address)
+            ret_val = None
+            if self._pool:
+                ret_val = self._pool.open(self._requestPath(url), self._requestHeaders())
+            if ret_val is None:
+                ret_val = urllib2.urlopen(url)
+            return URLFileWrapper(ret_val, lambda offset: self._openRange(url, offset))
         else:
             ret_val = urllib2.urlopen(self._url_concat(self._url.getURL(), address))
         return URLFileWrapper(ret_val)
 
+    def _openRange(self, url, offset):
+        """ Open url from offset onwards.  Returns the response and the
+        offset it starts at, which is 0 if the server ignored the range. """
+        headers = {'Range': 'bytes=%d-' % offset}
+        ret_val = None
+        if self._pool:
+            headers.update(self._requestHeaders())
+            ret_val = self._pool.open(self._requestPath(url), headers, httplib.PARTIAL_CONTENT)
+            if ret_val:
+                return (ret_val, offset)
+        ret_val = urllib2.urlopen(urllib2.Request(url, headers=headers))
+        if ret_val.getcode() != httplib.PARTIAL_CONTENT:
+            logger.log("Range request for %s returned the whole file" % url)
+            return (ret_val, 0)
+        return (ret_val, offset)
+
+    def _requestPath(self, url):
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        return path
+
+    def _requestHeaders(self):
+        headers = {}
+        username = self._url.getUsername()
+        if username is not None:
+            credentials = "%s:%s" % (username, self._url.getPassword() or '')
+            headers['Authorization'] = "Basic " + base64.b64encode(credentials)
+        return headers
+
     def url(self):
         return self._url
 
-def repositoriesFromDefinition(media, address, drivers=False):
+def _isMissing(e):
+    """ Return whether the exception raised opening a file means that
+    the file does not exist, rather than that the server failed. """
+    if isinstance(e, urllib2.HTTPError):
+        return e.code == httplib.NOT_FOUND
+    if isinstance(e, urllib2.URLError):
+        return False
+    return isinstance(e, IOError) and e.errno in (None, errno.ENOENT)
+
+class MirrorFile(object):
+    """ A file read from one of the mirrors of a MirrorAccessor.  Throughput
+    is accounted to the mirror when the file is closed; if a read fails the
+    file is reopened on another mirror at the same offset. """
+
+    def __init__(self, accessor, address):
+        self.accessor = accessor
+        self.address = address
+        self.offset = 0
+        self.mirror = None
+        self.fh = None
+        self.started = None
+        self.bytes = 0
+        self.failovers = 0
+        self._open()
+
+    def _open(self):
+        exc_info = None
+        for mirror in self.accessor._candidates():
+            try:
+                fh = mirror.openAddress(self.address)
+                if self.offset:
+                    fh.seek(self.offset)
+            except Exception:
+                exc_info = sys.exc_info()
+                if self.offset == 0 and _isMissing(exc_info[1]):
+                    break
+                self.accessor._failed(mirror, exc_info[1])
+                continue
+            self.mirror = mirror
+            self.fh = fh
+            self.started = time.time()
+            self.bytes = 0
+            self.accessor._opened(mirror)
+            return
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        raise IOError("No mirror available for %s" % self.address)
+
+    def _release(self, failed=None):
+        fh, self.fh = self.fh, None
+        try:
+            fh.close()
+        except Exception:
+            pass
+        self.accessor._closed(self.mirror, self.bytes, time.time() - self.started, failed)
+
+    def _call(self, method, *args):
+        """ Call method of the current file, failing over to another mirror
+        if it fails, at most once per mirror over the life of the file. """
+        while True:
+            if self.fh is None:
+                raise IOError("Reading %s failed on every mirror" % self.address)
+            try:
+                data = getattr(self.fh, method)(*args)
+            except Exception as e:
+                exc_info = sys.exc_info()
+                logger.log("Reading %s from %s failed at offset %d: %s" %
+                           (self.address, self.accessor._name(self.mirror), self.offset, str(e)))
+                self._release(e)
+                self.failovers += 1
+                if self.failovers >= len(self.accessor.mirrors):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                self._open()
+                continue
+            self.offset += len(data)
+            self.bytes += len(data)
+            return data
+
+    def read(self, size=-1):
+        return self._call('read', size)
+
+    def readline(self):
+        return self._call('readline')
+
+    def readlines(self):
+        return list(iter(self.readline, ''))
+
+    def close(self):
+        if self.fh:
+            self._release()
+
+class MirrorAccessor(Accessor):
+    """ Reads a repository from a list of equivalent mirrors, each given as
+    a (media, address) pair of type 'url' or 'nfs'.  Each file is read from
+    the mirror with the best throughput per file being read; mirrors which
+    fail are passed over for MIRROR_RETRY_INTERVAL seconds. """
+
+    def __init__(self, mirrors):
+        accessors = { 'url': URLAccessor,
+                      'nfs': NFSAccessor }
+        self.definitions = mirrors
+        self.mirrors = []
+        for media, address in mirrors:
+            if media not in accessors:
+                raise RuntimeError("Unsupported mirror media %s" % media)
+            self.mirrors.append(accessors[media](address))
+        if not self.mirrors:
+            raise RuntimeError("No mirrors given")
+        self._lock = threading.Lock()
+        self._stats = dict((m, {'bytes': 0, 'seconds': 0.0, 'active': 0, 'failed': 0})
+                           for m in self.mirrors)
+        self._started = []
+
+    def __repr__(self):
+        return "<MirrorAccessor: %s>" % ', '.join(str(a) for _, a in self.definitions)
+
+    def _name(self, mirror):
+        return str(self.definitions[self.mirrors.index(mirror)][1])
+
+    def _throughput(self, mirror):
+        stats = self._stats[mirror]
+        if stats['seconds'] <= 0:
+            return None
+        return stats['bytes'] / stats['seconds']
+
+    def _rank(self, mirror):
+        # unmeasured mirrors are tried first, least busy first
+        throughput = self._throughput(mirror)
+        if throughput is None:
+            return (0, self._stats[mirror]['active'])
+        return (1, -throughput / (self._stats[mirror]['active'] + 1))
+
+    def _candidates(self):
+        """ Return the mirrors in the order they should be tried. """
+        now = time.time()
+        with self._lock:
+            healthy = [m for m in self.mirrors if m in self._started and
+                       now - self._stats[m]['failed'] >= MIRROR_RETRY_INTERVAL]
+            failed = [m for m in self.mirrors if m in self._started and m not in healthy]
+            healthy.sort(key=self._rank)
+            failed.sort(key=lambda m: self._stats[m]['failed'])
+        return healthy + failed
+
+    def _opened(self, mirror):
+        with self._lock:
+            self._stats[mirror]['active'] += 1
+
+    def _closed(self, mirror, nbytes, seconds, failed=None):
+        with self._lock:
+            stats = self._stats[mirror]
+            stats['active'] -= 1
+            stats['bytes'] += nbytes
+            stats['seconds'] += seconds
+        if failed:
+            self._failed(mirror, failed)
+
+    def _failed(self, mirror, e):
+        logger.log("Mirror %s failed: %s" % (self._name(mirror), str(e)))
+        with self._lock:
+            self._stats[mirror]['failed'] = time.time()
+
+    def start(self):
+        for mirror in self.mirrors:
+            try:
+                mirror.start()
+            except Exception as e:
+                self._failed(mirror, e)
+                continue
+            with self._lock:
+                self._started.append(mirror)
+        if not self._started:
+            raise RuntimeError("None of the mirrors could be accessed")
+
+    def finish(self):
+        for mirror in self.mirrors:
+            with self._lock:
+                if mirror not in self._started:
+                    continue
+                self._started.remove(mirror)
+            mirror.finish()
+        if not self._started:
+            for mirror in self.mirrors:
+                stats = self._stats[mirror]
+                if stats['seconds'] > 0:
+                    logger.log("Mirror %s: %d bytes at %d KB/s" %
+                               (self._name(mirror), stats['bytes'], self._throughput(mirror) / 1024))
+
+    def access(self, name):
+        for mirror in self._candidates():
+            if mirror.access(name):
+                return True
+        return False
+
+    def openAddress(self, address):
+        return MirrorFile(self, address)
+
+    def isLocal(self):
+        return False
+
+    def stat(self, name):
+        # mirrors do not agree on modification times, so only the first is
+        # asked to keep stamps stable between installs
+        if self.mirrors[0] not in self._started:
+            return None
+        return self.mirrors[0].stat(name)
+
+    def maxConcurrentReads(self):
+        return sum(m.maxConcurrentReads() for m in self.mirrors)
+
+    def url(self):
+        return (self._candidates() or self.mirrors)[0].url()
+
+class PeerCacheAccessor(Accessor):
+    """ Reads packages from the payload caches of other installers where
+    they have them, and everything else from the origin accessor.  A
+    package from a peer is written to the payload cache and only used if
+    it matches its checksum from the repository metadata. """
+
+    def __init__(self, origin):
+        self.origin = origin
+
+    def __repr__(self):
+        return "<PeerCacheAccessor: %s>" % repr(self.origin)
+
+    def _fetch(self, peer, sha256sum, size):
+        """ Copy the package from peer to the payload cache, returning
+        whether a valid copy is now cached. """
+        out = payload_cache.reserve(sha256sum, size)
+        if not out:
+            # no room to check the package before it is used
+            return False
+        valid = False
+        try:
+            response = peercache.peers.open(peer, sha256sum)
+            if response:
+                m = hashlib.sha256()
+                try:
+                    while True:
+                        data = response.read(1048576)
+                        if data == '':
+                            break
+                        m.update(data)
+                        out.write(data)
+                finally:
+                    response.close()
+                valid = m.hexdigest() == sha256sum
+                if not valid:
+                    logger.log("Peer cache at %s:%d sent a corrupt copy of %s" % (peer + (sha256sum,)))
+                    peercache.peers.failed(peer, bad=True)
+        except Exception as e:
+            logger.log("Peer cache at %s:%d failed: %s" % (peer + (str(e),)))
+            peercache.peers.failed(peer)
+        finally:
+            payload_cache.commit(sha256sum, out, valid)
+        return valid
+
+    def openPayload(self, name, sha256sum, size):
+        for peer in peercache.peers.candidates():
+            if self._fetch(peer, sha256sum, size):
+                cached = payload_cache.open(sha256sum)
+                if cached:
+                    return cached
+        return self.origin.openPayload(name, sha256sum, size)
+
+    def access(self, name):
+        return self.origin.access(name)
+
+    def openAddress(self, address):
+        return self.origin.openAddress(address)
+
+    def isLocal(self):
+        return self.origin.isLocal()
+
+    def stat(self, name):
+        return self.origin.stat(name)
+
+    def maxConcurrentReads(self):
+        return self.origin.maxConcurrentReads()
+
+    def start(self):
+        self.origin.start()
+
+    def finish(self):
+        self.origin.finish()
+
+    def url(self):
+        return self.origin.url()
+
+def definitionKey(media, address):
+    """ Return a hashable key for a repository source definition. """
+    if media == 'mirrors':
+        address = tuple(definitionKey(m, a) for m, a in address)
+    elif isinstance(address, util.URL):
+        address = address.getURL()
+    return (media, address)
+
+class RepositoryRegistry(object):
+    """ Repositories found from each source definition, so that the
+    metadata of a source is read once per install however often it is
+    looked up.  The accessors of registered repositories are kept started
+    (e.g. media stay mounted) until release() or releaseMedia() is called. """
+
+    def __init__(self):
+        self._entries = {}
+        self._started = []
+        self._lock = threading.Lock()
+        # definition key -> lock held while its repositories are found
+        self._finding = {}
+
+    @staticmethod
+    def _key(media, address):
+        return definitionKey(media, address)
+
+    def lookup(self, media, address, complete=True):
+        """ Return the repositories registered for the definition, or None.
+        If complete is set, results of lookups which stopped at the main
+        repository are not returned. """
+        with self._lock:
+            entry = self._entries.get(self._key(media, address))
+        if entry and (entry[1] or not complete):
+            return entry[0]
+        return None
+
+    def add(self, media, address, repos, complete=True):
+        with self._lock:
+            self._entries[self._key(media, address)] = (repos, complete)
+            for repo in repos:
+                if repo.accessor() not in self._started:
+                    repo.accessor().start()
+                    self._started.append(repo.accessor())
+
+    def find(self, media, address, complete, find):
+        """ Return the repositories registered for the definition, or else
+        those returned by find(), which are registered if there are any.
+        Concurrent lookups of a definition wait for the first one, so its
+        accessors are only created once. """
+        with self._lock:
+            finding = self._finding.setdefault(self._key(media, address), threading.Lock())
+        with finding:
+            repos = self.lookup(media, address, complete)
+            if repos is None:
+                repos = find()
+                if repos:
+                    self.add(media, address, repos, complete)
+        return repos
+
+    def forgetAccessor(self, accessor):
+        """ Drop the definitions whose repositories use accessor, e.g.
+        because its media has been ejected. """
+        with self._lock:
+            for key, (repos, _) in self._entries.items():
+                if accessor in [r.accessor() for r in repos]:
+                    del self._entries[key]
+            if accessor in self._started:
+                self._started.remove(accessor)
+                accessor.finish()
+
+    def releaseMedia(self):
+        """ Unmount the media (local devices, NFS) of registered
+        repositories, which stay registered and are mounted again when
+        they are installed from. """
+        with self._lock:
+            media = [a for a in self._started if isinstance(a, MountingAccessor)]
+            self._started = [a for a in self._started if a not in media]
+        for accessor in media:
+            accessor.finish()
+
+    def release(self):
+        with self._lock:
+            started, self._started = self._started, []
+            self._entries = {}
+        for accessor in started:
+            accessor.finish()
+
+registry = RepositoryRegistry()
+
+def repositoriesFromDefinition(media, address, drivers=False, stop_at_main=False):
+    """ Return the repositories found from a source definition.  Results
+    are kept in the registry, except for driver repositories (driver disks
+    are swapped in the same drive) and empty results (so that a retry after
+    inserting media looks again). """
+    if drivers:
+        return _repositoriesFromDefinition(media, address, drivers, stop_at_main)
+
+    return registry.find(media, address, not stop_at_main,
+                         lambda: _repositoriesFromDefinition(media, address, drivers, stop_at_main))
+
+def _repositoriesFromDefinition(media, address, drivers, stop_at_main):
     if media == 'local':
         # this is a special case as we need to locate the media first
-        return findRepositoriesOnMedia(drivers)
+        return findRepositoriesOnMedia(drivers, stop_at_main)
     else:
         accessors = { 'filesystem': FilesystemAccessor,
                       'url': URLAccessor,
-                      'nfs': NFSAccessor }
+                      'nfs': NFSAccessor,
+                      'mirrors': MirrorAccessor }
         if media in accessors:
             accessor = accessors[media](address)
         else:
             raise RuntimeError("Unknown repository media %s" % media)
+        if peercache.peers.enabled and not accessor.isLocal():
+            accessor = PeerCacheAccessor(accessor)
 
         accessor.start()
         if drivers:
@@ -738,8 +1919,53 @@ def repositoriesFromDefinition(media, address, drivers=False):
         accessor.finish()
         return [rv] if rv else []
 
-def findRepositoriesOnMedia(drivers=False):
-    """ Returns a list of repositories available on local media. """
+class RepositoryLoader(object):
+    """ Resolves repository definitions on a background thread, so that their
+    metadata is fetched while the installer is busy with something else.
+    Local media are left to be scanned on demand as the scan mounts every
+    block device, including the one that may be being partitioned. """
+
+    def __init__(self, definitions):
+        self._definitions = [(media, address) for media, address in definitions
+                             if media != 'local']
+        self._results = {}
+        self._thread = threading.Thread(target=self._load)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _key(media, address):
+        return definitionKey(media, address)
+
+    def _load(self):
+        for media, address in self._definitions:
+            key = self._key(media, address)
+            if key in self._results:
+                continue
+            logger.log("Loading repositories from %s %s in the background" % (media, address))
+            try:
+                self._results[key] = (repositoriesFromDefinition(media, address), None)
+            except:
+                self._results[key] = (None, sys.exc_info())
+
+    def repositoriesFromDefinition(self, media, address):
+        """ As repositoriesFromDefinition, waiting for the background load if
+        the definition is part of it. """
+        key = self._key(media, address)
+        if key in [self._key(*d) for d in self._definitions]:
+            self._thread.join()
+        if key not in self._results:
+            return repositoriesFromDefinition(media, address)
+
+        repos, exc_info = self._results[key]
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return repos
+
+def findRepositoriesOnMedia(drivers=False, stop_at_main=False):
+    """ Returns a list of repositories available on local media.  If
+    stop_at_main is set, devices not yet probed once a main repository is
+    found are skipped. """
 
     static_device_patterns = [ 'sd*', 'scd*', 'sr*', 'xvd*', 'nvme*n*', 'vd*' ]
     static_devices = []
@@ -765,70 +1991,297 @@ def findRepositoriesOnMedia(drivers=False):
                 if dev not in parent_devices:
                     parent_devices.append(dev)
 
-    da = None
+    found_main = threading.Event()
+
+    def probe(check):
+        device_path = "/dev/%s" % check
+        if found_main.is_set() or not os.path.exists(device_path):
+            return None
+        # don't mount devices which cannot hold installation media
+        fs = diskutil.probeFilesystem(device_path)
+        if not fs:
+            logger.log("Not looking for repositories on %s: no suitable filesystem" % device_path)
+            return None
+        logger.log("Looking for repositories: %s (%s)" % (device_path, fs))
+        da = DeviceAccessor(device_path, [fs])
+        try:
+            da.start()
+        except util.MountFailureException:
+            return None
+        try:
+            if drivers:
+                repo = da.findDriverRepository()
+            else:
+                repo = da.findRepository()
+        finally:
+            da.finish()
+        if repo and stop_at_main and repo.identifier() == MAIN_REPOSITORY_NAME:
+            found_main.set()
+        return repo
+
+    # Devices are probed concurrently; repositories are returned in device
+    # order regardless.
+    results = util.parallelMap(probe, parent_devices + partitions, MEDIA_PROBE_WORKERS)
     repos = []
-    try:
-        for check in parent_devices + partitions:
-            device_path = "/dev/%s" % check
-            logger.log("Looking for repositories: %s" % device_path)
-            if os.path.exists(device_path):
-                da = DeviceAccessor(device_path)
+    for repo, exc_info in results:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if repo:
+            repos.append(repo)
+    return repos
+
+class YumTransactionProgress(object):
+    """ Size-weighted progress of a yum transaction, from the events of
+    yumtransaction.py and the installerprogress yum plugin, passed on to
+    progress_callback with the time left: downloading takes it to 10%,
+    installing to 90% and verifying to 100%.  Packages the plugin did not
+    report count as the average size. """
+
+    def __init__(self, progress_callback):
+        self.progress_callback = progress_callback
+        self.sizes = {}
+        self.total_size = 0
+        self.installed_bytes = {}
+        self.done_size = 0
+        self.download_size = 0
+        self.downloaded_bytes = {}
+        self.downloaded_size = 0
+        self.start = None
+        self.structured = False
+        self.shown = 0
+        self.shown_eta = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(package):
+        # yum prints the epoch in some places but not others
+        return re.sub(r'^\d+:', '', package)
+
+    def _size(self, key, total):
+        if key in self.sizes:
+            return self.sizes[key]
+        if self.sizes:
+            return self.total_size / len(self.sizes)
+        return total
+
+    def _show(self, percent, text=None):
+        # events and yum's output arrive on different threads
+        if percent > self.shown or text:
+            self.shown = max(percent, self.shown)
+            if text:
+                self.progress_callback(self.shown, text)
+            else:
+                self.progress_callback(self.shown)
+
+    def show(self, percent):
+        with self.lock:
+            self._show(percent)
+
+    def event(self, record):
+        with self.lock:
+            event = record['event']
+            if event == 'package' and record.get('state') in ('i', 'u'):
+                size = record.get('installed_size') or record.get('size') or 0
+                self.sizes[self._key(record['id'])] = size
+                self.total_size += size
+            elif event == 'download-start':
+                self.download_size = record.get('size') or 0
+            elif event == 'download-progress' and self.download_size:
+                done = record.get('bytes') or 0
+                self.downloaded_size += done - self.downloaded_bytes.get(record['name'], 0)
+                self.downloaded_bytes[record['name']] = done
+                self._show(3 + min(self.downloaded_size * 7 / self.download_size, 7))
+            elif event == 'transaction-start':
+                self.start = time.time()
+                self._show(10)
+            elif event == 'install-progress' and record.get('total'):
+                self.structured = True
+                key = self._key(record['id'])
+                # rpm counts the bytes of the payload, the plugin the
+                # installed size, so scale the one to the other
+                done = (self._size(key, record['total']) * record['bytes']) / record['total']
+                self.done_size += done - self.installed_bytes.get(key, 0)
+                self.installed_bytes[key] = done
+                self._showInstalled()
+            elif event == 'verify' and self.sizes:
+                self._show(90 + min((record['count'] * 10) / len(self.sizes), 10))
+
+    def installed(self, package):
+        """ Record that package was installed, from yum's output when there
+        are no install-progress events. """
+        with self.lock:
+            if self.structured or not self.sizes or self.total_size == 0:
+                return False
+            key = self._key(package)
+            size = self._size(key, 0)
+            self.done_size += size - self.installed_bytes.get(key, 0)
+            self.installed_bytes[key] = size
+            self._showInstalled()
+            return True
+
+    def _showInstalled(self):
+        total_size = max(self.total_size, self.done_size, 1)
+        text = None
+        eta = self._eta(total_size)
+        if eta is not None:
+            minutes = (eta + 59) / 60
+            if minutes != self.shown_eta:
+                self.shown_eta = minutes
+                if minutes > 1:
+                    text = "Installing packages, about %d minutes left" % minutes
+                else:
+                    text = "Installing packages, about a minute left"
+                logger.log("YUM: %d%% of package data installed, about %ds left" % (
+                    (self.done_size * 100) / total_size, eta))
+        self._show(10 + (self.done_size * 80) / total_size, text)
+
+    def _eta(self, total_size):
+        if self.start is None or self.done_size == 0:
+            return None
+        elapsed = time.time() - self.start
+        return int(elapsed * (total_size - self.done_size) / self.done_size)
+
+def _readYumEvents(callback):
+    """ Pass the events of yumtransaction.py and the installerprogress yum
+    plugin to callback as they arrive.  Returns the environment to run yum with, the write end of
+    the events pipe (to close once yum has started) and the reading thread,
+    which finishes with yum. """
+    events_r, events_w = os.pipe()
+    env = dict(os.environ)
+    env['INSTALLER_PROGRESS_FD'] = str(events_w)
+
+    def read_events():
+        with os.fdopen(events_r) as events:
+            # not 'for line in events', which reads ahead
+            for line in iter(events.readline, ''):
                 try:
-                    da.start()
-                except util.MountFailureException:
-                    da = None
+                    record = json.loads(line)
+                except ValueError:
                     continue
-                else:
-                    if drivers:
-                        repo = da.findDriverRepository()
-                    else:
-                        repo = da.findRepository()
-                    if repo:
-                        repos.append(repo)
-                    da.finish()
-                    da = None
+                logger.log("YUM EVENT: %s" % line.strip())
+                callback(record)
+    events_thread = threading.Thread(target=read_events)
+    events_thread.daemon = True
+    events_thread.start()
+    return env, events_w, events_thread
+
+def resolveYumTransaction(targets, mounts):
+    """ Return the set of (repository identifier, location) of the
+    packages yum would install for targets, or None if the transaction
+    could not be resolved. """
+    packages = set()
+    resolved = []
+
+    def event(record):
+        if record.get('event') == 'package' and record.get('state') in ('i', 'u'):
+            packages.add((record.get('repo'), record.get('location')))
+        elif record.get('event') == 'resolved':
+            resolved.append(True)
+
+    env, events_w, events_thread = _readYumEvents(event)
+    yum_command = ['yum', '-c', '/root/yum.conf',
+                   '--installroot', mounts['root'],
+                   '--assumeno', 'install'] + targets
+    logger.log("Resolving yum transaction: %s" % ' '.join(yum_command))
+    try:
+        p = subprocess.Popen(yum_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
     finally:
-        if da:
-            da.finish()
-
-    return repos
+        os.close(events_w)
+    for line in iter(p.stdout.readline, ''):
+        logger.log("YUM: %s" % line.rstrip())
+    # yum exits with an error when the transaction is declined
+    p.wait()
+    events_thread.join(5)
+
+    if not resolved:
+        logger.log("Yum transaction could not be resolved")
+        return None
+    logger.log("Yum transaction has %d packages" % len(packages))
+    return packages
+
+def _copyIntoTarget(path, root):
+    """ Copy path to the same location under root unless something is
+    already there, returning the copy or None. """
+    dest = os.path.join(root, path.lstrip('/'))
+    if os.path.lexists(dest):
+        return None
+    if not os.path.isdir(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest))
+    shutil.copy2(path, dest)
+    return dest
 
 def installFromYum(targets, mounts, progress_callback, cachedir):
         # Use a temporary file to avoid deadlocking
         stderr = tempfile.TemporaryFile()
 
-        yum_command = ['yum', '-c', '/root/yum.conf',
-                       '--installroot', mounts['root'],
-                       'install', '-y'] + targets
+        # Progress events from yumtransaction.py and the installerprogress
+        # plugin arrive on a pipe, alongside yum's output
+        transaction = YumTransactionProgress(progress_callback)
+        env, events_w, events_thread = _readYumEvents(transaction.event)
+
+        preload_copy = None
+        if os.path.exists(YUM_TRANSACTION_SCRIPT):
+            yum_command = [sys.executable, YUM_TRANSACTION_SCRIPT]
+        else:
+            logger.log("%s not found, running the yum command" % YUM_TRANSACTION_SCRIPT)
+            yum_command = ['yum']
+        yum_command += ['-c', '/root/yum.conf', '--installroot', mounts['root']]
+        if constants.RELAXED_DURABILITY:
+            yum_command += ['--setopt=tsflags=nodocs',
+                            '--setopt=override_install_langs=en_US']
+            # suppress fsync in yum and rpm; scriptlets run chrooted in the
+            # target and inherit the preload, so the library is put there too
+            if os.path.exists(EATMYDATA_LIB):
+                env['LD_PRELOAD'] = EATMYDATA_LIB
+                preload_copy = _copyIntoTarget(EATMYDATA_LIB, mounts['root'])
+            else:
+                logger.log("%s not found, package writes will be synced" % EATMYDATA_LIB)
+        if yum_command[0] == 'yum':
+            yum_command += ['install', '-y']
+        yum_command += targets
         logger.log("Running yum: %s" % ' '.join(yum_command))
-        p = subprocess.Popen(yum_command, stdout=subprocess.PIPE, stderr=stderr)
-        count = 0
-        total = 0
-        verify_count = 0
-        while True:
-            line = p.stdout.readline()
-            if not line:
-                break
-            line = line.rstrip()
-            logger.log("YUM: %s" % line)
-            if line == 'Resolving Dependencies':
-                progress_callback(1)
-            elif line == 'Dependencies Resolved':
-                progress_callback(3)
-            elif line.startswith('-----------------------------------------'):
-                progress_callback(7)
-            elif line == 'Running transaction':
-                progress_callback(10)
-            elif line.endswith(' will be installed') or line.endswith(' will be updated'):
-                total += 1
-            elif line.startswith('  Installing : ') or line.startswith('  Updating : '):
-                count += 1
-                if total > 0:
-                    progress_callback(10 + int((count * 80.0) / total))
-            elif line.startswith('  Verifying  : '):
-                verify_count += 1
-                progress_callback(90 + int((verify_count * 10.0) / total))
-        rv = p.wait()
+        try:
+            try:
+                p = subprocess.Popen(yum_command, stdout=subprocess.PIPE, stderr=stderr, env=env)
+            finally:
+                os.close(events_w)
+            # yum's output only marks the steps, and counts the packages
+            # installed when there are no install-progress events
+            count = 0
+            total = 0
+            verify_count = 0
+            while True:
+                line = p.stdout.readline()
+                if not line:
+                    break
+                line = line.rstrip()
+                logger.log("YUM: %s" % line)
+                if line == 'Resolving Dependencies':
+                    transaction.show(1)
+                elif line == 'Dependencies Resolved':
+                    transaction.show(3)
+                elif line.startswith('-----------------------------------------'):
+                    transaction.show(7)
+                elif line == 'Running transaction':
+                    transaction.show(10)
+                elif line.endswith(' will be installed') or line.endswith(' will be updated'):
+                    total += 1
+                elif transaction.structured:
+                    continue
+                elif line.startswith('  Installing : ') or line.startswith('  Updating : '):
+                    count += 1
+                    package = line.split(' : ', 1)[1].rsplit(None, 1)[0].strip()
+                    if not transaction.installed(package) and total > 0:
+                        transaction.show(10 + (count * 80) / total)
+                elif line.startswith('  Verifying  : '):
+                    verify_count += 1
+                    transaction.show(90 + (verify_count * 10) / max(total, 1))
+            rv = p.wait()
+        finally:
+            if preload_copy:
+                os.unlink(preload_copy)
+        # scriptlets don't inherit the pipe, so this finishes with yum
+        events_thread.join(5)
         stderr.seek(0)
         stderr = stderr.read()
         if stderr:
@@ -848,36 +2301,158 @@ def installFromRepos(progress_callback, repos, mounts):
         repo._accessor.start()
 
     try:
-        # Build a yum config
-        with open('/root/yum.conf', 'w') as yum_conf:
-            yum_conf.write(_generateYumConf(cachedir))
-            for repo in repos:
-                url = repo._accessor.url()
-                yum_conf.write("""
-[%s]
-name=%s
-baseurl=%s
-""" % (repo.identifier(), repo.identifier(), url.getPlainURL()))
-                username = url.getUsername()
-                if username is not None:
-                    yum_conf.write("username=%s\n" % (url.getUsername(),))
-                password = url.getPassword()
-                if password is not None:
-                    yum_conf.write("password=%s\n" % (url.getPassword(),))
-                repo_config = repo._repo_config()
-                if repo_config is not None:
-                    yum_conf.write(repo_config)
-
+        # With a root filesystem image the main repository's package groups
+        # are already installed once it is unpacked, so only the targets of
+        # the other repositories are left for yum.
+        image_repos = []
+        yum_repos = repos
+        if repos[0].hasRootfsImage():
+            image_repos, yum_repos = repos[:1], repos[1:]
 
-        repos[0].disableInitrdCreation(mounts['root'])
         targets = []
-        for repo in repos:
+        for repo in yum_repos:
             if repo._targets:
                 targets += repo._targets
         targets = list(set(targets))
 
-        installFromYum(targets, mounts, progress_callback, cachedir)
+        # Progress: unpacking the image, then yum
+        image_share = 0
+        if image_repos:
+            image_share = 50 if targets else 100
+
+        if image_repos:
+            image_repos[0].installRootfsImage(
+                lambda x, *text: progress_callback((x * image_share) / 100, *text), mounts)
+
+        repos[0].disableInitrdCreation(mounts['root'])
+        if targets:
+            installFromYumRepos(repos, targets, mounts,
+                                lambda x, *text: progress_callback(image_share + (x * (100 - image_share)) / 100, *text),
+                                cachedir, _generateYumConf(cachedir))
         repos[0].enableInitrdCreation()
     finally:
         for repo in repos:
             repo._accessor.finish()
+
+def writeYumConf(repos, yum_conf_main, urls={}):
+    """ Write the yum configuration for repos, using the URLs given for
+    some of them in place of their accessors' URLs. """
+    with open('/root/yum.conf', 'w') as yum_conf:
+        yum_conf.write(yum_conf_main)
+        for repo in repos:
+            url = urls.get(repo, repo._accessor.url())
+            yum_conf.write("""
+[%s]
+name=%s
+baseurl=%s
+""" % (repo.identifier(), repo.identifier(), url.getPlainURL()))
+            username = url.getUsername()
+            if username is not None:
+                yum_conf.write("username=%s\n" % (url.getUsername(),))
+            password = url.getPassword()
+            if password is not None:
+                yum_conf.write("password=%s\n" % (url.getPassword(),))
+            repo_config = repo._repo_config()
+            if repo_config is not None:
+                yum_conf.write(repo_config)
+
+def installFromYumRepos(repos, targets, mounts, progress_callback, cachedir, yum_conf_main):
+    """ Install targets from repos with yum.  The packages of the
+    transaction which come from remote repositories are fetched
+    concurrently first, so that yum installs from local copies rather
+    than downloading one package at a time. """
+    staging_dir = os.path.join(mounts['root'], STAGING_DIR)
+    remote_repos = [r for r in repos if not r._accessor.isLocal()]
+    writeYumConf(repos, yum_conf_main)
+
+    # Progress: staging packages, then yum
+    staging_share = 30 if remote_repos else 0
+    try:
+        if remote_repos:
+            needed = resolveYumTransaction(targets, mounts)
+            # yum must read the metadata of the staged copies afresh
+            shutil.rmtree(os.path.join(mounts['root'], cachedir), True)
+
+            staged = []
+            for repo in remote_repos:
+                if needed is None:
+                    packages = list(repo)
+                else:
+                    packages = [p for p in repo if (repo.identifier(), p.name) in needed]
+                staged.append((repo, packages))
+            total_size = max(sum(p.size for _, packages in staged for p in packages), 1)
+
+            urls = {}
+            done_size = 0
+            for repo, packages in staged:
+                def stage_progress(x, start=done_size):
+                    progress_callback(((start + x) * staging_share) / total_size)
+                repo_dir = os.path.join(staging_dir, repo.identifier().replace(':', '_'))
+                stagePackages(repo, repo_dir, packages, stage_progress)
+                urls[repo] = util.URL("file://%s" % repo_dir)
+                done_size += sum(p.size for p in packages)
+            writeYumConf(repos, yum_conf_main, urls)
+
+        installFromYum(targets, mounts,
+                       lambda x, *text: progress_callback(staging_share + (x * (100 - staging_share)) / 100, *text),
+                       cachedir)
+    finally:
+        if os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir)
+
+class StagingCancelled(Exception):
+    pass
+
+def stagePackages(repo, dest, packages, progress=lambda x: ()):
+    """ Copy the metadata of repo and the packages given to dest, fetching
+    packages concurrently and checking each one as it arrives.  progress
+    is called with the number of bytes staged.  The first failure stops
+    the fetches still running. """
+    accessor = repo.accessor()
+    logger.log("Staging %d packages of %s in %s" % (len(packages), repo, dest))
+
+    for name in repo._repodata + [repo.REPOMD_FILENAME + '.asc']:
+        path = os.path.join(dest, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        try:
+            infh = accessor.openAddress(name)
+        except Exception:
+            # the signature is optional
+            if name.endswith('.asc'):
+                continue
+            raise
+        try:
+            with open(path, 'wb') as outfh:
+                shutil.copyfileobj(infh, outfh, 1048576)
+        finally:
+            infh.close()
+
+    staged = {}
+    staged_size = [0]
+    failed = threading.Event()
+    lock = threading.Lock()
+
+    def stage_package(p):
+        def progress_fn(x):
+            if failed.is_set():
+                raise StagingCancelled()
+            size = (p.size * x) / 100
+            with lock:
+                staged_size[0] += size - staged.get(p, 0)
+                staged[p] = size
+                progress(staged_size[0])
+        if failed.is_set():
+            raise StagingCancelled()
+        try:
+            p.stage(os.path.join(dest, p.name), progress_fn)
+        except StagingCancelled:
+            raise
+        except:
+            failed.set()
+            raise
+
+    results = util.parallelMap(stage_package, packages, accessor.maxConcurrentReads())
+    for _, exc_info in results:
+        if exc_info and not isinstance(exc_info[1], StagingCancelled):
+            raise exc_info[0], exc_info[1], exc_info[2]
@@ -18,6 +18,7 @@ import tui
 import tui.progress
 from uicontroller import SKIP_SCREEN, LEFT_BACKWARDS, RIGHT_FORWARDS, REPEAT_STEP
 import repository
+import progressbus
 import generalui
 import urlparse
 import urllib
@@ -46,7 +47,8 @@ def check_repo_def(definition, require_base_repo):
     repositories. """
     try:
         tui.progress.showMessageDialog("Please wait", "Searching for repository...")
-        repos = repository.repositoriesFromDefinition(*definition)
+        # only whether there is a main repository matters here
+        repos = repository.repositoriesFromDefinition(*definition, stop_at_main=require_base_repo)
         tui.progress.clearModelessDialog()
     except Exception as e:
         logger.log("Exception trying to access repository: %s" % e)
@@ -349,19 +351,17 @@ def verify_source(answers, label, require_base_repo):
 def interactive_source_verification(repos, label):
     cap_label = ' '.join(map(lambda a: a.capitalize(), label.split()))
     errors = []
-    pd = tui.progress.initProgressDialog(
+    pd = progressbus.ProgressBus(
         "Verifying %s Source" % cap_label, "Initializing...",
-        len(repos) * 100
+        len(repos) * 100, tui
         )
-    tui.progress.displayProgressDialog(0, pd)
     for i in range(len(repos)):
         r = repos[i]
         def progress(x):
-            #print i * 100 + x
-            tui.progress.displayProgressDialog(i*100 + x, pd, "Checking %s..." % r.name())
+            pd.update(i*100 + x, "Checking %s..." % r.name())
         errors.extend(r.check(progress))
 
-    tui.progress.clearModelessDialog()
+    pd.finish()
 
     if len(errors) != 0:
         errtxt = generalui.makeHumanList([x.name for x in errors])
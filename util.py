@@ -12,6 +12,7 @@
 
 import os
 import os.path
+import sys
 import subprocess
 import urllib
 import urllib2
@@ -24,6 +25,10 @@ import random
 import string
 import tempfile
 import errno
+import threading
+import Queue
+import ctypes
+import ctypes.util
 from version import *
 from xcp import logger
 
@@ -105,6 +110,59 @@ def runCmd2(command, with_stdout=False, with_stderr=False, inputtext=None):
         return rv, err
     return rv
 
+###
+# concurrency
+
+def parallelMap(fn, items, max_workers):
+    """ Apply fn to each of items on up to max_workers threads.  Returns a
+    list of (result, exc_info) pairs in the order of items, where exc_info
+    is None if fn returned normally and sys.exc_info() if it raised. """
+
+    items = list(items)
+    results = [None] * len(items)
+    work = Queue.Queue()
+    for i in range(len(items)):
+        work.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (fn(items[i]), None)
+            except:
+                results[i] = (None, sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(max_workers, len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+###
+# page cache hints
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _posix_fadvise = _libc.posix_fadvise
+    _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+except (OSError, AttributeError, TypeError):
+    _posix_fadvise = None
+
+def fadvise(fd, offset, length, advice):
+    """ Advise the kernel how a range of fd will be accessed, if it
+    supports it.  Hints which cannot be given are ignored. """
+    if _posix_fadvise:
+        _posix_fadvise(fd, offset, length, advice)
+
 ###
 # make file system
 
@@ -17,8 +17,22 @@ import sys
 import fcntl
 import datetime
 import traceback
+import simplejson as json
 import constants
 
+TIMELINE_FILE = 'install-timeline.json'
+
+# Timing records of the install tasks executed so far, see backend.Task.
+task_timeline = []
+
+def recordTask(record):
+    """ Add the timing record of an executed task to the timeline. """
+    task_timeline.append(record)
+
+def writeTimeline(dst):
+    """ Write the task timeline as JSON into directory 'dst'. """
+    with open(os.path.join(dst, TIMELINE_FILE), 'w') as f:
+        json.dump(task_timeline, f, indent=1)
 
 def collectLogs(dst, tarball_dir=None):
     """ Make a support tarball including all logs (and some more) from 'dst'."""
@@ -38,6 +52,10 @@ def collectLogs(dst, tarball_dir=None):
     os.system("vgscan -P >%s/vgscan-log 2>&1" % dst)
     os.system("cat /var/log/multipathd >%s/multipathd-log 2>&1" % dst)
     os.system("rpm -qa >%s/rpm-qa-log 2>&1" % dst)
+    try:
+        writeTimeline(dst)
+    except:
+        pass
 
     if not tarball_dir:
         tarball_dir = dst
@@ -47,7 +65,7 @@ def collectLogs(dst, tarball_dir=None):
             shutil.copy("/tmp/install-log", dst)
         if os.path.exists(constants.SCRIPTS_DIR):
             os.system("cp -r "+constants.SCRIPTS_DIR+" %s/" % dst)
-    logs = filter(lambda x: x.endswith('-log') or x == 'answerfile' or
+    logs = filter(lambda x: x.endswith('-log') or x in ('answerfile', TIMELINE_FILE) or
                   x.startswith(os.path.basename(constants.SCRIPTS_DIR)), os.listdir(dst))
     logs = " ".join(logs)
 
@@ -0,0 +1,58 @@
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Yum plugin reporting the packages and phases of a transaction to the
+# installer, as one JSON object per line on the file descriptor given in
+# the INSTALLER_PROGRESS_FD environment variable.
+
+import os
+import fcntl
+import json
+
+from yum.plugins import TYPE_CORE
+
+requires_api_version = '2.3'
+plugin_type = (TYPE_CORE,)
+
+_out = None
+
+def _emit(event, **record):
+    if _out:
+        record['event'] = event
+        _out.write(json.dumps(record) + "\n")
+        _out.flush()
+
+def init_hook(conduit):
+    global _out
+    fd = os.environ.get('INSTALLER_PROGRESS_FD')
+    if fd:
+        fd = int(fd)
+        # don't pass the descriptor on to package scriptlets
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        _out = os.fdopen(fd, 'w')
+
+def postresolve_hook(conduit):
+    for member in conduit.getTsInfo().getMembers():
+        po = member.po
+        _emit('package', id=str(po), name=po.name, state=member.ts_state,
+              size=po.size, installed_size=po.installedsize,
+              repo=po.repoid, location=getattr(po, 'relativepath', None))
+    _emit('resolved')
+
+def predownload_hook(conduit):
+    pkgs = conduit.getDownloadPackages()
+    _emit('download-start', count=len(pkgs), size=sum(po.size for po in pkgs))
+
+def postdownload_hook(conduit):
+    _emit('download-done', errors=len(conduit.getErrors()))
+
+def pretrans_hook(conduit):
+    _emit('transaction-start')
+
+def posttrans_hook(conduit):
+    _emit('transaction-done')
@@ -0,0 +1,178 @@
+# Copyright (c) 2005-2006 XenSource, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and conditions
+# as licensed by XenSource, Inc. All other rights reserved.
+# Xen, XenSource and XenEnterprise are either registered trademarks or
+# trademarks of XenSource Inc. in the United States and/or other countries.
+
+###
+# XEN CLEAN INSTALLER
+# Runs a yum install transaction for the installer, which yum's command
+# line cannot report the progress of.  Alongside the events of the
+# installerprogress plugin, one JSON object per line is written to the
+# file descriptor given in the INSTALLER_PROGRESS_FD environment variable:
+# - download-progress: bytes of a package downloaded so far;
+# - install-progress: bytes of a package installed so far;
+# - verify: number of packages verified so far.
+# The progress lines of the yum command are printed too, for the log.
+#
+#   yumtransaction.py -c CONF --installroot ROOT [--setopt OPT=VALUE] TARGET...
+
+import fcntl
+import json
+import optparse
+import os
+import sys
+import time
+
+import yum
+import yum.Errors
+from yum.callbacks import ProcessTransBaseCallback, PT_DOWNLOAD, PT_TEST_TRANS, PT_TRANSACTION
+from yum.constants import TS_INSTALL, TS_TRUEINSTALL, TS_UPDATE, TS_OBSOLETING
+from yum.rpmtrans import RPMBaseCallback
+from urlgrabber.progress import BaseMeter
+
+# actions which write a package to the target
+INSTALL_ACTIONS = [TS_INSTALL, TS_TRUEINSTALL, TS_UPDATE, TS_OBSOLETING]
+
+# least number of seconds between progress events of one package
+EVENT_INTERVAL = 0.5
+
+_fd = None
+
+def emit(event, **record):
+    if _fd is not None:
+        record['event'] = event
+        # one write per event, so that lines from the plugin don't mix in
+        os.write(_fd, json.dumps(record) + "\n")
+
+class DownloadMeter(BaseMeter):
+    """ Reports the bytes downloaded of each package.  BaseMeter already
+    limits how often updates are made. """
+
+    def _do_start(self, now=None):
+        emit('download-progress', name=self.basename, bytes=0, total=self.size)
+
+    def _do_update(self, amount_read, now=None):
+        emit('download-progress', name=self.basename, bytes=amount_read, total=self.size)
+
+    def _do_end(self, amount_read, now=None):
+        emit('download-progress', name=self.basename, bytes=amount_read, total=self.size)
+
+class TransactionPhases(ProcessTransBaseCallback):
+    MESSAGES = {PT_DOWNLOAD: 'Downloading packages:',
+                PT_TEST_TRANS: 'Running transaction check',
+                PT_TRANSACTION: 'Running transaction'}
+
+    def event(self, state, data=None):
+        if state in self.MESSAGES:
+            print self.MESSAGES[state]
+            sys.stdout.flush()
+
+class InstallProgress(RPMBaseCallback):
+    """ Reports the bytes installed of each package, as rpm writes it. """
+
+    def __init__(self):
+        RPMBaseCallback.__init__(self)
+        self.last_event = {}
+        self.finished = set()
+
+    def event(self, package, action, te_current, te_total, ts_current, ts_total):
+        if action not in INSTALL_ACTIONS:
+            return
+        key = str(package)
+        if key in self.finished:
+            return
+        done = te_current >= te_total
+        now = time.time()
+        if not done and now - self.last_event.get(key, 0) < EVENT_INTERVAL:
+            return
+        self.last_event[key] = now
+        emit('install-progress', id=key, bytes=te_current, total=te_total)
+        if done:
+            self.finished.add(key)
+            print "  %s : %s %d/%d" % (self.action[action], key, ts_current, ts_total)
+            sys.stdout.flush()
+
+    def scriptout(self, package, msgs):
+        if msgs:
+            sys.stdout.write(msgs)
+            sys.stdout.flush()
+
+    def errorlog(self, msg):
+        sys.stderr.write(msg + "\n")
+
+    def filelog(self, package, action):
+        pass
+
+    def verify_txmbr(self, base, txmbr, count):
+        print "  Verifying  : %s %d/%d" % (txmbr.po, count, len(base.tsInfo))
+        sys.stdout.flush()
+        emit('verify', id=str(txmbr.po), count=count)
+
+def install(yb, targets):
+    for target in targets:
+        try:
+            if target.startswith('@'):
+                yb.selectGroup(target[1:])
+            else:
+                yb.install(pattern=target)
+        except (yum.Errors.GroupsError, yum.Errors.InstallError) as e:
+            # as yum does, go on with the other targets
+            print "No package %s available: %s" % (target, e)
+
+    print 'Resolving Dependencies'
+    sys.stdout.flush()
+    rc, msgs = yb.buildTransaction()
+    if rc == 1:
+        for msg in msgs:
+            sys.stderr.write("Error: %s\n" % msg)
+        return 1
+    if rc == 0 or len(yb.tsInfo) == 0:
+        sys.stderr.write("Error: Nothing to do\n")
+        return 1
+    print 'Dependencies Resolved'
+    for txmbr in yb.tsInfo.getMembers():
+        if txmbr.ts_state in ('i', 'u'):
+            print "---> Package %s will be %s" % (txmbr.po, 'updated' if txmbr.ts_state == 'u' else 'installed')
+    sys.stdout.flush()
+
+    yb.repos.setProgressBar(DownloadMeter())
+    yb.processTransaction(callback=TransactionPhases(), rpmDisplay=InstallProgress())
+    return 0
+
+def main():
+    global _fd
+
+    parser = optparse.OptionParser()
+    parser.add_option('-c', dest='conf', default='/etc/yum.conf')
+    parser.add_option('--installroot', default='/')
+    parser.add_option('--setopt', action='append', default=[])
+    opts, targets = parser.parse_args()
+
+    fd = os.environ.get('INSTALLER_PROGRESS_FD')
+    if fd:
+        _fd = int(fd)
+        # don't pass the descriptor on to package scriptlets
+        fcntl.fcntl(_fd, fcntl.F_SETFD, fcntl.fcntl(_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    yb = yum.YumBase()
+    yb.preconf.fn = opts.conf
+    yb.preconf.root = opts.installroot
+    yb.preconf.debuglevel = 2
+    yb.preconf.errorlevel = 2
+    try:
+        for setopt in opts.setopt:
+            name, value = setopt.split('=', 1)
+            setattr(yb.conf, name, yb.conf.optionobj(name).parse(value))
+        yb.doLock()
+        try:
+            return install(yb, targets)
+        finally:
+            yb.closeRpmDB()
+            yb.doUnlock()
+    except yum.Errors.YumBaseError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())